@@ -1,10 +1,24 @@
+import csv
+import os
+import tempfile
+from html import escape
 from aiogram import Router, F
 from aiogram.filters import Command 
 from aiogram.types import Message
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, CallbackQuery, FSInputFile
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 from config import ADMIN_IDS
-from models import User, FolderSubscription, async_session
-from sqlalchemy import select
+from models import User, FolderSubscription
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from handlers import safe_edit
+from utils import escape_clip, utf16_len
+from metrics import (
+    scan_cycle_seconds, task_scan_seconds, scan_dirs_total, scan_stat_calls_total, scan_errors_total,
+    subscribed_folders, model_db_read_seconds, model_db_cache_total,
+    notify_queue_depth, notify_send_seconds, notify_lag_seconds, notify_sent_total, notify_errors_total,
+    handler_seconds, handler_errors_total,
+)
 
 admin_router = Router()
 
@@ -13,6 +27,8 @@ async def admin_command_handler(message: Message):
     kb = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="/users_list")],
+            [KeyboardButton(text="/users_export")],
+            [KeyboardButton(text="/stats")],
             [KeyboardButton(text="/exit")],
         ],
         resize_keyboard=True
@@ -30,44 +46,199 @@ async def exit_admin_handler(message: Message):
     )
     await message.reply("👤 <b>Обычный режим пользователя</b>", reply_markup=user_kb)
 
+USERS_PER_PAGE = 10
+FOLDERS_PREVIEW = 5
+# Лимиты полей в единицах UTF-16 после экранирования: блок без превью папок
+# гарантированно помещается в MAX_MESSAGE_LEN / USERS_PER_PAGE
+USERNAME_PREVIEW = 40
+NAME_PREVIEW = 60
+FOLDER_PREVIEW_LEN = 50
+MAX_MESSAGE_LEN = 4096
+
+
+def render_user_block(user: User, count: int, folders: list[str]) -> str:
+    block = f"👤 <b>Пользователь:</b> @{escape_clip(user.username or 'без username', USERNAME_PREVIEW)}\n"
+    block += f"🆔 ID: {user.id} | TG ID: {user.tg_id}\n"
+
+    name_parts = [part for part in (user.first_name, user.last_name) if part]
+    if name_parts:
+        block += f"📝 Имя: {escape_clip(' '.join(name_parts), NAME_PREVIEW)}\n"
+
+    if count:
+        block += f"📂 <b>Подписки ({count}):</b>\n"
+        for i, folder in enumerate(folders, 1):
+            block += f"   {i}. 📁 {escape_clip(folder, FOLDER_PREVIEW_LEN)}\n"
+        if count > len(folders):
+            block += f"   … и ещё {count - len(folders)}\n"
+    else:
+        block += "📂 <i>Нет активных подписок</i>\n"
+
+    return block + "┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄\n"
+
+
+async def render_users_page(session: AsyncSession, page: int):
+    """
+    Страница списка пользователей: счётчики подписок — одним агрегирующим
+    запросом, первые FOLDERS_PREVIEW папок — вторым (оконная функция),
+    так что объём работы не зависит от общего числа пользователей.
+    """
+    total = await session.scalar(select(func.count(User.id)))
+    if not total:
+        return None, None
+    pages = (total + USERS_PER_PAGE - 1) // USERS_PER_PAGE
+    page = min(max(1, page), pages)
+
+    subs_count = func.count(FolderSubscription.id).label("subs_count")
+    result = await session.execute(
+        select(User, subs_count)
+        .outerjoin(FolderSubscription, FolderSubscription.user_id == User.id)
+        .group_by(User.id)
+        .order_by(User.id)
+        .limit(USERS_PER_PAGE)
+        .offset((page - 1) * USERS_PER_PAGE)
+    )
+    rows = result.all()
+
+    ranked = select(
+        FolderSubscription.user_id,
+        FolderSubscription.folder_path,
+        func.row_number().over(
+            partition_by=FolderSubscription.user_id, order_by=FolderSubscription.id
+        ).label("rn"),
+    ).where(FolderSubscription.user_id.in_([user.id for user, _ in rows])).subquery()
+    folders_result = await session.execute(
+        select(ranked.c.user_id, ranked.c.folder_path)
+        .where(ranked.c.rn <= FOLDERS_PREVIEW)
+        .order_by(ranked.c.user_id, ranked.c.rn)
+    )
+    folders: dict[int, list[str]] = {}
+    for user_id, folder_path in folders_result:
+        folders.setdefault(user_id, []).append(folder_path)
+
+    response = f"Registered Users ({total}), стр. {page}/{pages}:\n\n"
+    # Каждому пользователю страницы — равная доля лимита: если блок не влезает,
+    # у него сокращается превью папок, а не выпадает сам пользователь
+    budget = (MAX_MESSAGE_LEN - utf16_len(response)) // USERS_PER_PAGE
+    for user, count in rows:
+        preview = folders.get(user.id, [])
+        for shown in range(len(preview), -1, -1):
+            block = render_user_block(user, count, preview[:shown])
+            if utf16_len(block) <= budget:
+                break
+        response += block
+
+    kb = InlineKeyboardBuilder()
+    if page > 1:
+        kb.button(text="⬅️ Назад", callback_data=f"users_page:{page - 1}")
+    if page < pages:
+        kb.button(text="➡️ Вперёд", callback_data=f"users_page:{page + 1}")
+    kb.button(text="📄 Выгрузить всё", callback_data="users_export")
+    kb.adjust(2)
+    return response, kb.as_markup()
+
+
 @admin_router.message(Command('users_list'), F.from_user.id.in_(ADMIN_IDS))
-async def users_list_handler(message: Message):
-    async with async_session() as session:
-        
-        result = await session.execute(select(User))
-        users = result.unique().scalars().all()
-        
-        if not users:
-            await message.reply("No users found.")
-            return
-        
-        subs_res = await session.execute(select(FolderSubscription))
-        subs = subs_res.scalars().all()
-            
-        response = "Registered Users:\n\n"
-        for user in users:
-            folder_names = [sub.folder_path for sub in subs if user.id == sub.user_id]
-            
-            response += f"👤 <b>Пользователь:</b> @{user.username or 'без username'}\n"
-            response += f"🆔 ID: {user.id} | TG ID: {user.tg_id}\n"
-            
-            if user.first_name or user.last_name:
-                name_parts = []
-                if user.first_name:
-                    name_parts.append(user.first_name)
-                if user.last_name:
-                    name_parts.append(user.last_name)
-                response += f"📝 Имя: {' '.join(name_parts)}\n"
-            
-            if folder_names:
-                response += f"📂 <b>Подписки ({len(folder_names)}):</b>\n"
-                for i, folder in enumerate(folder_names, 1):
-                    if len(folder) > 50:
-                        folder = folder[:47] + "..."
-                    response += f"   {i}. 📁 {folder}\n"
-            else:
-                response += "📂 <i>Нет активных подписок</i>\n"
-            
-            response += "┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄┄\n"
-                
-        await message.reply(response)
\ No newline at end of file
+async def users_list_handler(message: Message, session: AsyncSession):
+    response, kb = await render_users_page(session, 1)
+    if response is None:
+        await message.reply("No users found.")
+        return
+    await message.reply(response, reply_markup=kb)
+
+
+@admin_router.callback_query(F.data.startswith("users_page:"), F.from_user.id.in_(ADMIN_IDS))
+async def users_page_callback(callback: CallbackQuery, session: AsyncSession):
+    page = int(callback.data.split("users_page:")[1])
+    response, kb = await render_users_page(session, page)
+    if response is None:
+        await callback.answer("No users found.", show_alert=True)
+        return
+    await safe_edit(callback, response, reply_markup=kb)
+    await callback.answer()
+
+
+async def export_users(session: AsyncSession, target: Message):
+    """
+    Выгрузка всех пользователей и подписок в CSV. Строки читаются потоком
+    (session.stream) и сразу пишутся во временный файл, в памяти целиком
+    не собираются.
+    """
+    result = await session.stream(
+        select(User.id, User.tg_id, User.username, User.first_name, User.last_name,
+               FolderSubscription.folder_path)
+        .outerjoin(FolderSubscription, FolderSubscription.user_id == User.id)
+        .order_by(User.id, FolderSubscription.id)
+    )
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(["id", "tg_id", "username", "first_name", "last_name", "folder_path"])
+            async for partition in result.partitions(500):
+                writer.writerows(partition)
+        await target.answer_document(FSInputFile(path, filename="users.csv"))
+    finally:
+        os.remove(path)
+
+
+@admin_router.message(Command('users_export'), F.from_user.id.in_(ADMIN_IDS))
+async def users_export_handler(message: Message, session: AsyncSession):
+    await export_users(session, message)
+
+
+@admin_router.callback_query(F.data == "users_export", F.from_user.id.in_(ADMIN_IDS))
+async def users_export_callback(callback: CallbackQuery, session: AsyncSession):
+    await callback.answer()
+    await export_users(session, callback.message)
+
+
+def _ms(value) -> str:
+    if value is None:
+        return "—"
+    if value == float("inf"):
+        return "&gt;60 с"
+    return f"{value * 1000:.0f} мс"
+
+
+def _timing(histogram, **labels) -> str:
+    count, total = histogram.summary(**labels)
+    if not count:
+        return "нет данных"
+    return (f"{count} шт., ср. {_ms(total / count)}, p50 ≤ {_ms(histogram.quantile(0.5, **labels))}, "
+            f"p99 ≤ {_ms(histogram.quantile(0.99, **labels))}")
+
+
+def render_stats() -> str:
+    errors = ", ".join(f"{key[0]}: {value:g}" for key, value in scan_errors_total.values.items()) or "нет"
+    send_errors = ", ".join(f"{key[0]}: {value:g}" for key, value in notify_errors_total.values.items()) or "нет"
+    cache = {key[0]: value for key, value in model_db_cache_total.values.items()}
+
+    text = "📊 <b>Статистика</b>\n\n"
+    text += "<b>Сканирование</b>\n"
+    text += f"Папок с подписками: {subscribed_folders.get():g}\n"
+    text += f"Цикл: {_timing(scan_cycle_seconds)}\n"
+    text += f"Папка задания: {_timing(task_scan_seconds)}\n"
+    text += f"Прочитано папок: {scan_dirs_total.total():g}, вызовов stat: {scan_stat_calls_total.total():g}\n"
+    text += f"Ошибки: {errors}\n\n"
+    text += "<b>Model.db3</b>\n"
+    text += f"Чтение: {_timing(model_db_read_seconds)}\n"
+    text += f"Кэш: попаданий {cache.get('hit', 0):g}, промахов {cache.get('miss', 0):g}\n\n"
+    text += "<b>Уведомления</b>\n"
+    text += f"В очереди: {notify_queue_depth.get():g}, отправлено: {notify_sent_total.total():g}\n"
+    text += f"Отправка: {_timing(notify_send_seconds)}\n"
+    text += f"Задержка доставки: {_timing(notify_lag_seconds)}\n"
+    text += f"Ошибки: {send_errors}\n\n"
+    text += "<b>Хендлеры</b>\n"
+    handlers = sorted(handler_seconds.values, key=lambda key: -handler_seconds.summary(handler=key[0])[0])
+    for (name,) in handlers[:15]:
+        failed = handler_errors_total.get(handler=name)
+        text += f"{escape(name)}: {_timing(handler_seconds, handler=name)}"
+        text += f", ошибок {failed:g}\n" if failed else "\n"
+    if not handlers:
+        text += "нет данных\n"
+    return text
+
+
+@admin_router.message(Command('stats'), F.from_user.id.in_(ADMIN_IDS))
+async def stats_handler(message: Message):
+    await message.reply(render_stats())
@@ -0,0 +1,8 @@
+"""
+Бенчмарки наблюдателя без рабочей шары и настоящего токена.
+
+    python -m bench.run_benchmarks --out bench_results.json
+
+Скрипты сами выставляют переменные окружения (FILES_ROOT, DATABASE_URL и т.д.)
+на временную папку до импорта модулей бота.
+"""
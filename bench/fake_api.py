@@ -0,0 +1,175 @@
+"""
+Локальная подмена Telegram Bot API на aiohttp для нагрузочных тестов.
+
+getUpdates отдаёт апдейты из очереди, которую наполняет драйвер; sendMessage,
+editMessageText, answerCallbackQuery и sendDocument принимаются и
+записываются. Драйвер ждёт ответ бота конкретному чату через expect().
+Токен из URL сохраняется в журнале вызовов — по нему различаются процессы,
+запущенные с разными BOT_TOKEN (bench.shard_test).
+"""
+import asyncio
+import itertools
+import json
+import time
+from aiohttp import web
+
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+REPLY_METHODS = {"sendmessage", "editmessagetext", "senddocument"}
+
+
+class Reply:
+    """Ответ бота чату: метод, текст и callback_data инлайн-кнопок."""
+
+    def __init__(self, method: str, params: dict):
+        self.method = method
+        self.chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        self.text = params.get("text") or params.get("caption") or ""
+        self.message_id = None
+        self.buttons: list[str] = []
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        for row in (markup or {}).get("inline_keyboard", []):
+            for button in row:
+                if button.get("callback_data"):
+                    self.buttons.append(button["callback_data"])
+
+
+class FakeTelegramAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.updates: asyncio.Queue[dict] = asyncio.Queue()
+        self.calls: dict[str, int] = {}
+        # (time.monotonic(), токен, метод) каждого запроса и все ответы бота чатам
+        self.log: list[tuple[float, str, str]] = []
+        self.replies: list[Reply] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self._callback_chats: dict[str, int] = {}
+        self._waiters: dict[int, asyncio.Future] = {}
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---------------- Сторона драйвера ----------------
+
+    def _user(self, chat_id: int) -> dict:
+        return {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}", "username": f"user{chat_id}"}
+
+    def _chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private", "first_name": f"User {chat_id}"}
+
+    def expect(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = future
+        return future
+
+    def push_message(self, chat_id: int, text: str):
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": self._chat(chat_id),
+            "from": self._user(chat_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.updates.put_nowait({"update_id": next(self._update_ids), "message": message})
+
+    def push_callback(self, chat_id: int, data: str, message_id: int | None):
+        callback_id = str(next(self._callback_ids))
+        self._callback_chats[callback_id] = chat_id
+        self.updates.put_nowait({"update_id": next(self._update_ids), "callback_query": {
+            "id": callback_id,
+            "from": self._user(chat_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+                "from": BOT_USER,
+                "text": "…",
+            },
+        }})
+
+    def _resolve(self, chat_id: int | None, reply: Reply):
+        future = self._waiters.pop(chat_id, None) if chat_id is not None else None
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    # ---------------- Сторона бота ----------------
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.method == "GET":
+            return dict(request.query)
+        if request.content_type == "application/json":
+            return await request.json()
+        form = await request.post()
+        return {key: value for key, value in form.items() if isinstance(value, str)}
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.log.append((time.monotonic(), request.match_info["token"], method))
+
+        if method == "getme":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method == "getupdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        if method in REPLY_METHODS:
+            reply = Reply(method, params)
+            chat_id = reply.chat_id
+            reply.message_id = int(params.get("message_id") or next(self._message_ids))
+            self.replies.append(reply)
+            self._resolve(chat_id, reply)
+            return web.json_response({"ok": True, "result": {
+                "message_id": reply.message_id,
+                "date": int(time.time()),
+                "chat": self._chat(chat_id or 0),
+                "from": BOT_USER,
+                "text": reply.text,
+            }})
+
+        if method == "answercallbackquery":
+            chat_id = self._callback_chats.pop(params.get("callback_query_id"), None)
+            # Пустой answer() только гасит «часики»; ответом считаем всплывающий текст
+            if params.get("text"):
+                self._resolve(chat_id, Reply(method, params))
+            return web.json_response({"ok": True, "result": True})
+
+        return web.json_response({"ok": True, "result": True})
+
+    async def _get_updates(self, params: dict) -> list[dict]:
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        try:
+            first = await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        batch = [first]
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
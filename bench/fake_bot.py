@@ -0,0 +1,48 @@
+"""Подмена aiogram.Bot для бенчмарков: записывает вызовы, имитирует задержку и flood control."""
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+
+@dataclass
+class FakeBot:
+    latency: float = 0.0
+    # Доля вызовов send_message, на которые отвечаем 429 с retry_after
+    retry_after_rate: float = 0.0
+    retry_after: int = 1
+    seed: int = 0
+    calls: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self.session = SimpleNamespace(close=self._close)
+        self.retries = 0
+
+    async def _close(self):
+        pass
+
+    async def send_message(self, chat_id: int, text: str, parse_mode=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_rate and self._random.random() < self.retry_after_rate:
+            self.retries += 1
+            raise TelegramRetryAfter(
+                method=SendMessage(chat_id=chat_id, text=text),
+                message="Too Many Requests",
+                retry_after=self.retry_after,
+            )
+        self.calls.append(("send_message", chat_id, time.monotonic()))
+        return SimpleNamespace(message_id=len(self.calls), chat_id=chat_id, text=text)
+
+    async def get_chat(self, chat_id: int, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append(("get_chat", chat_id, time.monotonic()))
+        return SimpleNamespace(id=chat_id, username=f"user{chat_id}", first_name=f"User {chat_id}")
+
+    def sent(self) -> int:
+        return sum(1 for call in self.calls if call[0] == "send_message")
@@ -0,0 +1,220 @@
+"""
+Нагрузочный тест хендлеров: настоящий Dispatcher с router и admin_router
+опрашивает локальную подмену Bot API (bench.fake_api), драйвер проигрывает
+сессии пользователей: /start → /subscribe → проект (иногда листает) → стадия
+→ задание → /my_subs → удаление подписки, /find.
+
+    python -m bench.load_test --users 200 --sessions 3 --out load_results.json
+
+Латентность шага — от появления апдейта в getUpdates до первого ответа бота
+этому чату. Результат — JSON с p50/p99 по шагам и общей пропускной способностью.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from bench.run_benchmarks import ROOT, setup_environment
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summarize(samples: list[float]) -> dict:
+    if not samples:
+        return {"n": 0}
+    return {"n": len(samples), "p50": percentile(samples, 0.5), "p90": percentile(samples, 0.9),
+            "p99": percentile(samples, 0.99), "max": max(samples)}
+
+
+class UserSession:
+    def __init__(self, api, chat_id: int, rng: random.Random, timeout: float, latencies: dict, failures: dict):
+        self.api = api
+        self.chat_id = chat_id
+        self.rng = rng
+        self.timeout = timeout
+        self.latencies = latencies
+        self.failures = failures
+        self.last = None
+
+    async def _step(self, label: str, push):
+        future = self.api.expect(self.chat_id)
+        started = time.perf_counter()
+        push()
+        try:
+            self.last = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.failures[label] = self.failures.get(label, 0) + 1
+            self.last = None
+            return None
+        self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+        return self.last
+
+    async def command(self, text: str):
+        return await self._step(text.split()[0], lambda: self.api.push_message(self.chat_id, text))
+
+    async def click(self, prefix: str):
+        """Нажимает случайную кнопку с callback_data, начинающимся на prefix."""
+        if self.last is None:
+            return None
+        buttons = [data for data in self.last.buttons if data.startswith(prefix)]
+        if not buttons:
+            return None
+        data = self.rng.choice(buttons)
+        label = data.split(":")[0] if ":" in data else data
+        message_id = self.last.message_id
+        return await self._step(label, lambda: self.api.push_callback(self.chat_id, data, message_id))
+
+    async def run(self, find_queries: list[str], admin: bool):
+        await self.command("/start")
+        await self.command("/subscribe")
+        if self.rng.random() < 0.3:
+            await self.click("page_next")
+        if await self.click("proj:") and await self.click("stage:"):
+            await self.click("task:")
+        await self.command("/my_subs")
+        if self.rng.random() < 0.5:
+            await self.click("delete_sub:")
+        if find_queries and self.rng.random() < 0.5:
+            await self.command(f"/find {self.rng.choice(find_queries)}")
+        if admin:
+            await self.command("/users_list")
+            await self.click("users_page:")
+
+
+async def run(args) -> dict:
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+    from bench.fake_api import FakeTelegramAPI
+    from bench.share_gen import ShareSpec, build_share
+    from admin_handlers import admin_router
+    from dir_tree import dir_tree
+    from folder_search import folder_search
+    from fsm_storage import CompactStorage
+    from handlers import router
+    from metrics import MetricsMiddleware
+    from middleware import DatabaseMiddleware
+    from models import engine, init_db
+    from path_index import path_index
+    from scanner import scan_executor
+    from user_profiles import user_registry
+
+    spec = ShareSpec(projects=args.projects, stages=args.stages, tasks=args.tasks, rvts=1, files=1, subdirs=0)
+    task_paths = build_share(os.environ["FILES_ROOT"], spec)
+    await init_db()
+    dir_tree.add_listener(path_index.on_tree_update)
+    dir_tree.add_listener(folder_search.on_tree_update)
+    await dir_tree.refresh()
+    # Первая сборка поискового индекса идёт в потоке — дожидаемся её
+    while len(folder_search) < len(task_paths):
+        await asyncio.sleep(0.05)
+
+    api = FakeTelegramAPI()
+    await api.start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api.base_url))
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=session,
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    storage = CompactStorage()
+    dp = Dispatcher(storage=storage)
+    dp.update.middleware(DatabaseMiddleware())
+    dp.include_router(router)
+    dp.include_router(admin_router)
+    for r in (router, admin_router):
+        r.message.middleware(MetricsMiddleware())
+        r.callback_query.middleware(MetricsMiddleware())
+    storage.start()
+    user_registry.start()
+
+    polling = asyncio.create_task(dp.start_polling(bot, polling_timeout=1, handle_signals=False))
+    latencies: dict[str, list[float]] = {}
+    failures: dict[str, int] = {}
+    find_queries = [os.path.basename(path)[-3:] for path in task_paths[:20]] + ["Стадия_1", "Проект_00"]
+    admin_id = int(os.environ["ADMIN_IDS"].split(",")[0])
+    semaphore = asyncio.Semaphore(args.concurrency or args.users)
+
+    async def user(index: int):
+        chat_id = admin_id if index == 0 else 10_000 + index
+        rng = random.Random(args.seed + index)
+        session_ = UserSession(api, chat_id, rng, args.timeout, latencies, failures)
+        async with semaphore:
+            for _ in range(args.sessions):
+                await session_.run(find_queries, admin=index == 0)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(user(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+        await storage.close()
+        await user_registry.close()
+        await bot.session.close()
+        await api.close()
+        scan_executor.shutdown()
+        await engine.dispose()
+
+    all_samples = [value for samples in latencies.values() for value in samples]
+    return {
+        "meta": {
+            "users": args.users, "sessions": args.sessions, "concurrency": args.concurrency or args.users,
+            "share": {**vars(spec), "task_folders": len(task_paths)},
+            "api_calls": api.calls,
+        },
+        "total": {**summarize(all_samples), "elapsed_seconds": elapsed,
+                  "throughput_per_second": len(all_samples) / elapsed if elapsed else None,
+                  "timeouts": sum(failures.values())},
+        "steps": {label: {**summarize(samples), "timeouts": failures.get(label, 0)}
+                  for label, samples in sorted(latencies.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sessions", type=int, default=2, help="сессий на пользователя")
+    parser.add_argument("--concurrency", type=int, default=0, help="одновременных пользователей (0 — все)")
+    parser.add_argument("--projects", type=int, default=30)
+    parser.add_argument("--stages", type=int, default=3)
+    parser.add_argument("--tasks", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=10, help="ожидание ответа на шаг, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="папка для шары и базы (по умолчанию временная)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    parser.add_argument("--out", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    args.real_limits = True
+
+    out = os.path.abspath(args.out) if args.out else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bot_load_")
+    os.makedirs(workdir, exist_ok=True)
+    os.environ.setdefault("ADMIN_IDS", "10000")
+    setup_environment(workdir, args)
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"✅ Результаты записаны в {out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Повторяемые бенчмарки путей сканирования и отправки на синтетической шаре.
+
+    python -m bench.run_benchmarks --subs 10,100,1000 --out bench_results.json
+
+Результат — JSON: параметры запуска и по каждому замеру min/median/p90/max
+в секундах, так что два файла можно сравнить и увидеть регрессию.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_environment(workdir: str, args):
+    """Переменные окружения до импорта config: всё состояние бота — во временной папке."""
+    os.environ["FILES_ROOT"] = os.path.join(workdir, "share")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["MTIME_INDEX_DIR"] = os.path.join(workdir, "mtime_index")
+    os.environ["METRICS_PORT"] = "0"
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_IDS", "0")
+    if not args.real_limits:
+        # Меряем код бота, а не лимиты Telegram
+        os.environ["NOTIFY_GLOBAL_RATE"] = "100000"
+        os.environ["NOTIFY_CHAT_RATE"] = "100000"
+    # bot.log пишется в текущую папку — уводим его из репозитория
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p90": ordered[min(len(ordered) - 1, math.ceil(0.9 * len(ordered)) - 1)],
+        "max": ordered[-1],
+        "mean": statistics.fmean(ordered),
+    }
+
+
+async def timed(coro_factory, repeat: int) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await coro_factory()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def make_watcher(fake_bot):
+    from file_watcher import FileWatcher
+    watcher = FileWatcher(os.environ["BOT_TOKEN"])
+    watcher.bot = fake_bot
+    watcher.dispatcher.bot = fake_bot
+    watcher.profile_refresher.bot = fake_bot
+    return watcher
+
+
+async def reset_database():
+    from models import Base, engine
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def create_subscriptions(task_paths: list[str], count: int) -> list[str]:
+    """count подписок: задание i % T, пользователь i // T — пары уникальны."""
+    from models import User, FolderSubscription, async_session
+    await reset_database()
+    users = math.ceil(count / len(task_paths))
+    async with async_session() as session:
+        session.add_all(User(tg_id=100000 + u, username=f"user{u}", first_name=f"User {u}") for u in range(users))
+        await session.flush()
+        session.add_all(
+            FolderSubscription(user_id=i // len(task_paths) + 1, folder_path=task_paths[i % len(task_paths)])
+            for i in range(count)
+        )
+        await session.commit()
+    return sorted({task_paths[i % len(task_paths)] for i in range(count)})
+
+
+async def bench_scan_primitives(results: list, share_root: str, task_paths: list[str], fake_bot, repeat: int):
+    from scanner import get_folder_mtime_recursive
+    from model_history import model_history
+
+    data = os.path.join(share_root, task_paths[0], "1.rvt", "Data")
+    samples = await timed(lambda: asyncio.to_thread(get_folder_mtime_recursive, data), repeat)
+    results.append({"name": "get_folder_mtime_recursive", "params": {"folder": "1.rvt/Data"},
+                    "stats": summarize(samples)})
+
+    watcher = make_watcher(fake_bot)
+
+    async def cold():
+        model_history._entries.clear()
+        await watcher.find_db_file(data)
+
+    results.append({"name": "find_db_file", "params": {"cache": "cold", "db_path_known": False},
+                    "stats": summarize(await timed(cold, repeat))})
+    results.append({"name": "find_db_file", "params": {"cache": "warm", "db_path_known": False},
+                    "stats": summarize(await timed(lambda: watcher.find_db_file(data), repeat))})
+    db_path = os.path.join(data, "Model.db3")
+    results.append({"name": "find_db_file", "params": {"cache": "warm", "db_path_known": True},
+                    "stats": summarize(await timed(lambda: watcher.find_db_file(data, db_path), repeat))})
+    await watcher.close()
+
+
+async def bench_check_folder_updates(results: list, share_root: str, task_paths: list[str], fake_bot,
+                                     sub_counts: list[int], repeat: int, change_fraction: float):
+    from bench.share_gen import touch_tasks
+    from models import async_session
+
+    for count in sub_counts:
+        subscribed = await create_subscriptions(task_paths, count)
+        shutil.rmtree(os.environ["MTIME_INDEX_DIR"], ignore_errors=True)
+        watcher = make_watcher(fake_bot)
+        watcher.dispatcher.start()
+
+        async def cycle():
+            async with async_session() as session:
+                await watcher.check_folder_updates(session)
+
+        params = {"subscriptions": count, "folders": len(subscribed)}
+        results.append({"name": "check_folder_updates", "params": {**params, "phase": "initial"},
+                        "stats": summarize(await timed(cycle, 1))})
+        results.append({"name": "check_folder_updates", "params": {**params, "phase": "idle"},
+                        "stats": summarize(await timed(cycle, repeat))})
+
+        changed = subscribed[:max(1, int(len(subscribed) * change_fraction))]
+        # Изменения сравниваются с точностью до секунды — переходим в следующую
+        await asyncio.sleep(1.01 - time.time() % 1)
+        touch_tasks(share_root, changed)
+        sent_before = fake_bot.sent()
+        scan_time = await timed(cycle, 1)
+        started = time.perf_counter()
+        await watcher.dispatcher.join()
+        delivery_time = time.perf_counter() - started
+        await watcher.flush_outbox_acks()
+        results.append({"name": "check_folder_updates", "params": {**params, "phase": "change",
+                                                                   "changed_folders": len(changed)},
+                        "stats": summarize(scan_time),
+                        "delivery_seconds": delivery_time,
+                        "messages_sent": fake_bot.sent() - sent_before})
+        await watcher.close()
+
+
+async def bench_notify_subscribers(results: list, share_root: str, task_paths: list[str], fake_bot,
+                                   counts: list[int]):
+    from datetime import datetime
+    from models import NotificationOutbox, async_session
+
+    for count in counts:
+        await create_subscriptions(task_paths, count)
+        watcher = make_watcher(fake_bot)
+        watcher.dispatcher.start()
+        entries = []
+        for i in range(count):
+            folder_path = task_paths[i % len(task_paths)]
+            data = os.path.join(share_root, folder_path, "1.rvt", "Data")
+            entries.append(NotificationOutbox(
+                id=i + 1, user_id=i // len(task_paths) + 1, folder_path=folder_path,
+                data_path=data, db_path=os.path.join(data, "Model.db3"), changed_at=datetime.now(),
+            ))
+
+        sent_before = fake_bot.sent()
+        started = time.perf_counter()
+        async with async_session() as session:
+            profiles = await watcher.profiles.resolve(session, [entry.user_id for entry in entries])
+        for entry in entries:
+            await watcher.notify_subscribers(entry, profiles.get(entry.user_id))
+        await watcher.digest.flush()
+        enqueue_time = time.perf_counter() - started
+        await watcher.dispatcher.join()
+        total_time = time.perf_counter() - started
+        results.append({"name": "notify_subscribers", "params": {"notifications": count},
+                        "enqueue_seconds": enqueue_time, "total_seconds": total_time,
+                        "messages_sent": fake_bot.sent() - sent_before,
+                        "throughput_per_second": count / total_time if total_time else None})
+        await watcher.close()
+
+
+async def run(args, workdir: str) -> dict:
+    from bench.fake_bot import FakeBot
+    from bench.share_gen import ShareSpec, build_share
+    from models import engine
+    from scanner import scan_executor
+
+    spec = ShareSpec(projects=args.projects, stages=args.stages, tasks=args.tasks, rvts=args.rvts,
+                     files=args.files, subdirs=args.subdirs)
+    share_root = os.environ["FILES_ROOT"]
+    started = time.perf_counter()
+    task_paths = build_share(share_root, spec)
+    generate_time = time.perf_counter() - started
+
+    fake_bot = FakeBot(latency=args.latency, retry_after_rate=args.retry_after_rate)
+    sub_counts = [int(x) for x in args.subs.split(",") if x]
+    results: list = []
+    try:
+        await reset_database()
+        await bench_scan_primitives(results, share_root, task_paths, fake_bot, args.repeat)
+        await bench_check_folder_updates(results, share_root, task_paths, fake_bot, sub_counts,
+                                         args.repeat, args.change_fraction)
+        await bench_notify_subscribers(results, share_root, task_paths, fake_bot, sub_counts)
+    finally:
+        scan_executor.shutdown()
+        await engine.dispose()
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "share": {**vars(spec), "task_folders": len(task_paths), "generate_seconds": generate_time},
+            "fake_bot": {"latency": args.latency, "retry_after_rate": args.retry_after_rate,
+                         "retry_after_raised": fake_bot.retries},
+            "env": {key: os.environ.get(key) for key in (
+                "SCAN_EXECUTOR", "SCAN_WORKERS", "WATCH_BACKEND", "DIGEST_WINDOW",
+                "FINGERPRINT_MODE", "NOTIFY_WORKERS", "NOTIFY_GLOBAL_RATE", "NOTIFY_CHAT_RATE",
+            )},
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subs", default="10,100,1000", help="число подписок через запятую")
+    parser.add_argument("--projects", type=int, default=5)
+    parser.add_argument("--stages", type=int, default=2)
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--rvts", type=int, default=2)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--subdirs", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--change-fraction", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.005, help="задержка FakeBot, с")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--real-limits", action="store_true", help="не снимать лимиты NOTIFY_*_RATE")
+    parser.add_argument("--workdir", help="папка для шары и базы (по умолчанию временная)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    parser.add_argument("--out", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out) if args.out else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bot_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    setup_environment(workdir, args)
+    try:
+        report = asyncio.run(run(args, workdir))
+    finally:
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"✅ Результаты записаны в {out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Проверка шардирования на одной машине: несколько процессов main.py
+(SHARDING_ENABLED=1) на общей SQLite-базе и синтетической шаре шлют
+уведомления в локальную подмену Bot API (bench.fake_api).
+
+    python -m bench.shard_test --workers 3 --bots 2 --out shard_results.json
+
+Первые --bots процессов запускаются с ролью all, остальные — watcher; у
+каждого свой BOT_TOKEN, чтобы по журналу API было видно, кто опрашивает
+getUpdates. Сценарий:
+  change   — изменения в части заданий: каждое уведомление должно прийти ровно один раз;
+  failover — держатель опроса убивается (SIGKILL), снова изменения: его папки
+             и опрос Telegram должны перейти к оставшимся процессам.
+Для PostgreSQL передайте --database-url (база должна быть пустой).
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+from bench.run_benchmarks import ROOT, setup_environment
+
+
+def worker_env(workdir: str, index: int, role: str, api_url: str, args) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "INSTANCE_ROLE": role,
+        "SHARDING_ENABLED": "1",
+        "WORKER_ID": f"worker-{index}",
+        "BOT_TOKEN": f"123456:shard-{index}",
+        "TELEGRAM_API_URL": api_url,
+        "MTIME_INDEX_DIR": os.path.join(workdir, f"mtime_index_{index}"),
+        "CHECK_INTERVAL": str(args.interval),
+        "WATCH_BACKEND": "polling",
+        "SHARD_HEARTBEAT_INTERVAL": str(args.heartbeat),
+        "SHARD_LEASE_TTL": str(args.lease_ttl),
+        "PYTHONPATH": ROOT,
+    })
+    return env
+
+
+async def spawn(workdir: str, index: int, role: str, api_url: str, args):
+    # Своя рабочая папка — свой bot.log
+    cwd = os.path.join(workdir, f"worker_{index}")
+    os.makedirs(cwd, exist_ok=True)
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, "main.py"), cwd=cwd,
+        env=worker_env(workdir, index, role, api_url, args),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+
+
+async def wait_for(predicate, timeout: float, step: float = 0.2) -> float | None:
+    """Ждёт выполнения условия; возвращает затраченное время или None по таймауту."""
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if await predicate():
+            return time.monotonic() - started
+        await asyncio.sleep(step)
+    return None
+
+
+def pollers(api, since: float) -> set[str]:
+    return {token for at, token, method in api.log if method == "getupdates" and at >= since}
+
+
+async def run(args) -> dict:
+    from sqlalchemy import func, select
+    from bench.fake_api import FakeTelegramAPI
+    from bench.run_benchmarks import create_subscriptions
+    from bench.share_gen import ShareSpec, build_share, touch_tasks
+    from models import FolderSubscription, WatcherWorker, async_session, engine
+
+    share_root = os.environ["FILES_ROOT"]
+    spec = ShareSpec(projects=args.projects, stages=args.stages, tasks=args.tasks, rvts=1, files=2, subdirs=0)
+    task_paths = build_share(share_root, spec)
+    subscribed = await create_subscriptions(task_paths, args.subs)
+    subscribers = {path: 0 for path in subscribed}
+    for i in range(args.subs):
+        subscribers[task_paths[i % len(task_paths)]] += 1
+
+    api = FakeTelegramAPI()
+    await api.start()
+    workdir = os.path.dirname(share_root)
+    processes = {}
+    for index in range(args.workers):
+        role = "all" if index < args.bots else "watcher"
+        processes[index] = await spawn(workdir, index, role, api.base_url, args)
+
+    async def scalar(query):
+        async with async_session() as session:
+            return await session.scalar(query)
+
+    async def all_joined():
+        return await scalar(select(func.count()).select_from(WatcherWorker)) == len(processes)
+
+    async def all_initialized():
+        pending = select(func.count()).select_from(FolderSubscription).where(FolderSubscription.last_modified.is_(None))
+        return await scalar(pending) == 0
+
+    def delivered(folders: list[str], since_reply: int) -> dict[str, int]:
+        counts = {folder: 0 for folder in folders}
+        for reply in api.replies[since_reply:]:
+            for folder in folders:
+                if folder in reply.text:
+                    counts[folder] += 1
+        return counts
+
+    async def change_phase(name: str, folders: list[str]) -> dict:
+        expected = sum(subscribers[folder] for folder in folders)
+        # mtime сравнивается с точностью до секунды
+        await asyncio.sleep(1.01 - time.time() % 1)
+        since_reply = len(api.replies)
+        touch_tasks(share_root, folders)
+
+        async def complete():
+            return sum(delivered(folders, since_reply).values()) >= expected
+
+        delivery = await wait_for(complete, args.timeout)
+        # Дубликаты могли бы прийти и позже — ждём ещё пару циклов
+        await asyncio.sleep(args.interval * 2 + args.heartbeat)
+        counts = delivered(folders, since_reply)
+        return {
+            "phase": name, "changed_folders": len(folders), "expected_messages": expected,
+            "messages": sum(counts.values()), "delivery_seconds": delivery,
+            "duplicates": sum(max(0, counts[f] - subscribers[f]) for f in folders),
+            "missing": sum(max(0, subscribers[f] - counts[f]) for f in folders),
+        }
+
+    phases = []
+    try:
+        joined = await wait_for(all_joined, args.timeout)
+        initialized = await wait_for(all_initialized, args.timeout)
+        startup = {"joined_seconds": joined, "initialized_seconds": initialized}
+
+        half = len(subscribed) // 2
+        step = max(1, int(half * args.change_fraction))
+        phases.append(await change_phase("change", subscribed[:step]))
+
+        # getUpdates — long polling, поэтому опрашивающих считаем за весь этап
+        startup["pollers"] = sorted(pollers(api, 0))
+        leader = startup["pollers"][0] if len(startup["pollers"]) == 1 else None
+        victim = int(leader.rsplit("-", 1)[1]) if leader else args.workers - 1
+        processes[victim].send_signal(signal.SIGKILL)
+        await processes[victim].wait()
+        killed_at = time.monotonic()
+
+        failover = await change_phase("failover", subscribed[half:half + step])
+        takeover = [at - killed_at for at, token, method in api.log
+                    if method == "getupdates" and at > killed_at and token != leader]
+        failover.update({"killed_worker": f"worker-{victim}", "was_polling": leader is not None,
+                         "polling_takeover_seconds": min(takeover) if takeover else None,
+                         "pollers_after": sorted(pollers(api, killed_at))})
+        phases.append(failover)
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes.values():
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        await api.close()
+        await engine.dispose()
+
+    return {
+        "meta": {
+            "workers": args.workers, "bots": args.bots, "interval": args.interval,
+            "heartbeat": args.heartbeat, "lease_ttl": args.lease_ttl,
+            "share": {**vars(spec), "task_folders": len(task_paths)},
+            "subscriptions": args.subs, "subscribed_folders": len(subscribed),
+            "database": os.environ["DATABASE_URL"].split("://")[0],
+        },
+        "startup": startup,
+        "phases": phases,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--bots", type=int, default=2, help="процессов с ролью all (претенденты на опрос)")
+    parser.add_argument("--projects", type=int, default=4)
+    parser.add_argument("--stages", type=int, default=2)
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--subs", type=int, default=200)
+    parser.add_argument("--change-fraction", type=float, default=0.2)
+    parser.add_argument("--interval", type=float, default=1, help="CHECK_INTERVAL воркеров, с")
+    parser.add_argument("--heartbeat", type=float, default=1, help="SHARD_HEARTBEAT_INTERVAL, с")
+    parser.add_argument("--lease-ttl", type=float, default=3, help="SHARD_LEASE_TTL, с")
+    parser.add_argument("--timeout", type=float, default=60, help="ожидание каждого этапа, с")
+    parser.add_argument("--database-url", help="общая база (по умолчанию SQLite в рабочей папке)")
+    parser.add_argument("--workdir", help="папка для шары и базы (по умолчанию временная)")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку")
+    parser.add_argument("--out", help="файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    args.real_limits = False
+
+    out = os.path.abspath(args.out) if args.out else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="bot_shard_")
+    os.makedirs(workdir, exist_ok=True)
+    setup_environment(workdir, args)
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"✅ Результаты записаны в {out}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Генератор синтетической шары: проекты / стадии / задания / N.rvt / Data
+с файлами и Model.db3 (таблица ModelHistory, как у Revit Server).
+
+    python -m bench.share_gen ./bench_share --projects 5 --stages 3 --tasks 10
+"""
+import argparse
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class ShareSpec:
+    projects: int = 5
+    stages: int = 3
+    tasks: int = 10
+    rvts: int = 2
+    files: int = 20
+    subdirs: int = 2
+    file_size: int = 1024
+    versions: int = 5
+    with_db: bool = True
+
+
+def create_model_db(path: str, versions: int):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("CREATE TABLE ModelHistory (VersionNumber INTEGER, Comment TEXT, UserName TEXT)")
+        conn.executemany(
+            "INSERT INTO ModelHistory VALUES (?, ?, ?)",
+            [(v, f"Комментарий {v}", f"user{v % 3}") for v in range(1, versions + 1)],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def add_model_version(path: str, comment: str = "Новая версия"):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(
+            "INSERT INTO ModelHistory SELECT COALESCE(MAX(VersionNumber), 0) + 1, ?, 'bench' FROM ModelHistory",
+            (comment,),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def build_share(root: str, spec: ShareSpec) -> list[str]:
+    """Создаёт дерево и возвращает относительные пути папок заданий."""
+    payload = os.urandom(spec.file_size)
+    task_paths = []
+    for p in range(spec.projects):
+        for s in range(spec.stages):
+            for t in range(spec.tasks):
+                rel_path = os.path.join(f"Проект_{p:03d}", f"Стадия_{s}", f"Задание_{t:03d}")
+                task_paths.append(rel_path)
+                for r in range(1, spec.rvts + 1):
+                    data = os.path.join(root, rel_path, f"{r}.rvt", "Data")
+                    dirs = [data] + [os.path.join(data, f"sub_{d}") for d in range(spec.subdirs)]
+                    for d in dirs:
+                        os.makedirs(d, exist_ok=True)
+                    for f in range(spec.files):
+                        with open(os.path.join(dirs[f % len(dirs)], f"element_{f}.dat"), "wb") as fh:
+                            fh.write(payload)
+                    if spec.with_db:
+                        create_model_db(os.path.join(data, "Model.db3"), spec.versions)
+    # Все файлы «старые», чтобы первое изменение было видно по mtime
+    past = time.time() - 3600
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames + dirnames:
+            os.utime(os.path.join(dirpath, name), (past, past))
+        os.utime(dirpath, (past, past))
+    return task_paths
+
+
+def touch_tasks(root: str, task_paths: list[str], new_version: bool = True) -> list[str]:
+    """Имитирует публикацию модели: новая версия в Model.db3 первой .rvt задания."""
+    changed = []
+    for rel_path in task_paths:
+        data = os.path.join(root, rel_path, "1.rvt", "Data")
+        db_path = os.path.join(data, "Model.db3")
+        if new_version and os.path.exists(db_path):
+            add_model_version(db_path)
+        else:
+            with open(os.path.join(data, "element_0.dat"), "ab") as fh:
+                fh.write(b"x")
+        changed.append(data)
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root")
+    for field, default in vars(ShareSpec()).items():
+        if isinstance(default, bool):
+            parser.add_argument(f"--no-{field.replace('_', '-')}", dest=field, action="store_false")
+        else:
+            parser.add_argument(f"--{field.replace('_', '-')}", type=int, default=default)
+    args = vars(parser.parse_args())
+    root = args.pop("root")
+    tasks = build_share(root, ShareSpec(**args))
+    print(f"✅ Создано заданий: {len(tasks)} в {root}")
+
+
+if __name__ == "__main__":
+    main()
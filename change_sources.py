@@ -0,0 +1,439 @@
+import asyncio
+import collections
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import os
+import struct
+import sys
+import time
+from typing import AsyncIterator
+from config import (
+    FILES_ROOT, CHECK_INTERVAL,
+    WATCH_BACKEND, WATCH_DEBOUNCE, WATCH_DEBOUNCE_MAX, WATCH_RESYNC_INTERVAL,
+    SCHEDULE_MIN_INTERVAL, SCHEDULE_MAX_INTERVAL, SCHEDULE_AGE_FACTOR, SCAN_BUDGET_PER_MINUTE,
+)
+from scanner import is_pruned_dir
+from utils import logger
+
+
+class ChangeSource:
+    """
+    Источник изменений для FileWatcher. changes() выдаёт набор относительных
+    путей папок заданий, которые нужно проверить, или None — проверить все.
+    """
+
+    def update_folders(self, folders: set[str]):
+        """Сообщает источнику актуальный набор папок, на которые есть подписки."""
+
+    def changes(self) -> AsyncIterator[set[str] | None]:
+        raise NotImplementedError
+
+    def record_scan(self, folder: str, latest_mtime: float | None):
+        """Результат скана папки: время последнего изменения в её Data (None — неизвестно)."""
+
+    def close(self):
+        pass
+
+
+class PollingChangeSource(ChangeSource):
+    """Периодический полный обход раз в CHECK_INTERVAL секунд."""
+
+    def __init__(self, interval: float = CHECK_INTERVAL):
+        self.interval = interval
+
+    async def changes(self):
+        while True:
+            yield None
+            await asyncio.sleep(self.interval)
+
+
+class AdaptiveChangeSource(ChangeSource):
+    """
+    Планировщик с отдельным сроком проверки у каждой папки задания (куча по
+    сроку). Интервал папки пропорционален возрасту её последнего изменения:
+    с которой работают сейчас, проверяется раз в SCHEDULE_MIN_INTERVAL, а
+    архивная отодвигается до SCHEDULE_MAX_INTERVAL. За любые 60 секунд
+    выдаётся не больше SCAN_BUDGET_PER_MINUTE папок — просроченные ждут
+    своей очереди в порядке срока, нагрузка на файловый сервер не растёт
+    с числом подписок.
+    """
+
+    def __init__(self, min_interval: float = SCHEDULE_MIN_INTERVAL, max_interval: float = SCHEDULE_MAX_INTERVAL,
+                 age_factor: float = SCHEDULE_AGE_FACTOR, budget_per_minute: int = SCAN_BUDGET_PER_MINUTE):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.age_factor = age_factor
+        self.budget_per_minute = max(1, budget_per_minute)
+
+        self._heap: list[tuple[float, str]] = []
+        # Актуальный срок папки; записи кучи с другим сроком устарели
+        self._deadlines: dict[str, float] = {}
+        self._intervals: dict[str, float] = {}
+        self._issued: collections.deque[float] = collections.deque()
+
+    def _schedule(self, folder: str, deadline: float):
+        self._deadlines[folder] = deadline
+        heapq.heappush(self._heap, (deadline, folder))
+
+    def update_folders(self, folders: set[str]):
+        for folder in set(self._deadlines) - folders:
+            del self._deadlines[folder]
+            self._intervals.pop(folder, None)
+        now = time.monotonic()
+        for folder in folders - set(self._deadlines):
+            # Новая папка проверяется сразу — это и инициализирует её интервал
+            self._schedule(folder, now)
+
+    def interval_for(self, latest_mtime: float | None, previous: float) -> float:
+        if latest_mtime is None:
+            # Изменение неизвестно (нет Data) — постепенно отодвигаем
+            interval = previous * 2
+        else:
+            interval = max(0.0, time.time() - latest_mtime) * self.age_factor
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def record_scan(self, folder: str, latest_mtime: float | None):
+        if folder not in self._deadlines:
+            return
+        interval = self.interval_for(latest_mtime, self._intervals.get(folder, self.min_interval))
+        self._intervals[folder] = interval
+        self._schedule(folder, time.monotonic() + interval)
+
+    def _pop_due(self, now: float, limit: int) -> set[str]:
+        due = set()
+        while self._heap and len(due) < limit:
+            deadline, folder = self._heap[0]
+            if self._deadlines.get(folder) != deadline:
+                heapq.heappop(self._heap)
+                continue
+            if deadline > now:
+                break
+            heapq.heappop(self._heap)
+            due.add(folder)
+            # Если скан не сообщит результат (ошибка, таймаут) — повтор через текущий интервал
+            self._schedule(folder, now + self._intervals.get(folder, self.min_interval))
+        return due
+
+    def _next_deadline(self) -> float | None:
+        while self._heap:
+            deadline, folder = self._heap[0]
+            if self._deadlines.get(folder) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    async def changes(self):
+        # Пустой набор: ничего не сканировать, только получить список папок из подписок
+        yield set()
+        last_yield = time.monotonic()
+
+        while True:
+            now = time.monotonic()
+            while self._issued and self._issued[0] <= now - 60:
+                self._issued.popleft()
+            budget = self.budget_per_minute - len(self._issued)
+
+            due = self._pop_due(now, budget) if budget > 0 else set()
+            if due or now - last_yield >= self.min_interval:
+                # Раз в min_interval выдаётся хотя бы пустой набор — так
+                # планировщик узнаёт о новых подписках
+                self._issued.extend([now] * len(due))
+                yield due
+                last_yield = time.monotonic()
+                continue
+
+            # Спим до ближайшего срока, а при исчерпанном бюджете — до его освобождения
+            wake_at = last_yield + self.min_interval
+            deadline = self._next_deadline()
+            if deadline is not None:
+                wake_at = min(wake_at, deadline if budget > 0 else max(deadline, self._issued[0] + 60))
+            await asyncio.sleep(max(0.0, wake_at - now))
+
+
+# Константы из <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+TASK_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+DATA_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE
+             | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyChangeSource(ChangeSource):
+    """
+    Событийный источник на inotify (только Linux). Наблюдает папки заданий и
+    деревья */Data внутри них; пачки событий от синхронизации Revit сливаются
+    в одно изменение: набор выдаётся после WATCH_DEBOUNCE секунд тишины, но не
+    позже WATCH_DEBOUNCE_MAX от первого события. Раз в WATCH_RESYNC_INTERVAL
+    выдаётся полный проход — на случай потерянных событий и изменений,
+    сделанных в обход ядра этого хоста (например, другим клиентом SMB).
+    """
+
+    def __init__(self, debounce: float = WATCH_DEBOUNCE, debounce_max: float = WATCH_DEBOUNCE_MAX,
+                 resync_interval: float = WATCH_RESYNC_INTERVAL):
+        self.debounce = debounce
+        self.debounce_max = debounce_max
+        self.resync_interval = resync_interval
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._wd_folder: dict[int, str] = {}
+        self._wd_path: dict[int, str] = {}
+        # Ссылки на задачи установки наблюдения, чтобы их не собрал сборщик мусора
+        self._tasks: set[asyncio.Task] = set()
+        self._folder_wds: dict[str, set[int]] = {}
+        self._folders: set[str] = set()
+        self._pending: set[str] = set()
+        self._full_pending = False
+        self._first_event_at: float | None = None
+        self._last_event_at = 0.0
+        self._event = asyncio.Event()
+        self._reader_added = False
+
+    def _add_watch(self, path: str, mask: int) -> int | None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.warning("Достигнут лимит inotify watches (fs.inotify.max_user_watches)")
+            elif err not in (errno.ENOENT, errno.ENOTDIR):
+                logger.warning(f"Не удалось добавить inotify watch на {path}: {os.strerror(err)}")
+            return None
+        return wd
+
+    def _watch_data_tree(self, data_path: str, wds: dict[int, str]):
+        """Наблюдение на дерево Data (или его поддерево) без служебных папок, как при сканировании."""
+        for root, dirs, _ in os.walk(data_path):
+            dirs[:] = [d for d in dirs if not is_pruned_dir(d)]
+            wd = self._add_watch(root, DATA_MASK)
+            if wd is not None:
+                wds[wd] = root
+
+    def _watch_rvt_folder(self, rvt_path: str, wds: dict[int, str]):
+        # Сама папка .rvt — чтобы заметить появление Data
+        wd = self._add_watch(rvt_path, TASK_MASK)
+        if wd is not None:
+            wds[wd] = rvt_path
+        self._watch_data_tree(os.path.join(rvt_path, "Data"), wds)
+
+    def _watch_folder_tree(self, folder: str) -> dict[int, str]:
+        """Ставит наблюдение на папку задания и все деревья */Data в ней. Выполняется в потоке."""
+        task_full_path = os.path.join(FILES_ROOT, folder)
+        wds = {}
+        wd = self._add_watch(task_full_path, TASK_MASK)
+        if wd is None:
+            return wds
+        wds[wd] = task_full_path
+        try:
+            with os.scandir(task_full_path) as it:
+                subfolders = [e.path for e in it if e.is_dir()]
+        except OSError:
+            return wds
+        for subfolder in subfolders:
+            self._watch_rvt_folder(subfolder, wds)
+        return wds
+
+    def _watch_new_dir(self, folder: str, path: str) -> dict[int, str]:
+        """Наблюдение только на появившуюся папку и её поддерево. Выполняется в потоке."""
+        wds = {}
+        parent = os.path.dirname(path)
+        task_full_path = os.path.join(FILES_ROOT, folder)
+        if parent == task_full_path:
+            self._watch_rvt_folder(path, wds)
+        elif os.path.dirname(parent) == task_full_path:
+            # Внутри .rvt интересна только Data
+            if os.path.basename(path) == "Data":
+                self._watch_data_tree(path, wds)
+        elif not is_pruned_dir(os.path.basename(path)):
+            self._watch_data_tree(path, wds)
+        return wds
+
+    def _add_wds(self, folder: str, wds: dict[int, str]):
+        for wd, path in wds.items():
+            self._wd_folder[wd] = folder
+            self._wd_path[wd] = path
+        self._folder_wds.setdefault(folder, set()).update(wds)
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _drop_wds(self, wds):
+        """Снимает наблюдение, поставленное для папки, которая за это время ушла (отписка, перебалансировка)."""
+        for wd in wds:
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    async def _register(self, folder: str):
+        wds = await asyncio.to_thread(self._watch_folder_tree, folder)
+        if folder not in self._folders:
+            self._drop_wds(wds)
+            return
+        self._add_wds(folder, wds)
+        # Изменения, случившиеся до установки наблюдения, подхватит проверка
+        self._mark(folder)
+
+    async def _register_dir(self, folder: str, path: str):
+        wds = await asyncio.to_thread(self._watch_new_dir, folder, path)
+        if folder not in self._folders:
+            self._drop_wds(wds)
+            return
+        self._add_wds(folder, wds)
+
+    def _unregister(self, folder: str):
+        for wd in self._folder_wds.pop(folder, set()):
+            self._wd_folder.pop(wd, None)
+            self._wd_path.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def update_folders(self, folders: set[str]):
+        for folder in self._folders - folders:
+            self._unregister(folder)
+        added = folders - self._folders
+        self._folders = set(folders)
+        for folder in added:
+            self._spawn(self._register(folder))
+
+    def _mark(self, folder: str | None):
+        now = time.monotonic()
+        if folder is None:
+            self._full_pending = True
+        else:
+            self._pending.add(folder)
+        if self._first_event_at is None:
+            self._first_event_at = now
+        self._last_event_at = now
+        self._event.set()
+
+    def _on_readable(self):
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"Ошибка чтения inotify: {e}")
+            return
+
+        rewatch = set()
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+            name_start = offset + _EVENT_HEADER.size
+            name = os.fsdecode(buf[name_start:name_start + name_len].split(b"\0", 1)[0])
+            offset = name_start + name_len
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Переполнение очереди inotify — будет выполнен полный проход")
+                self._mark(None)
+                continue
+            if mask & IN_IGNORED:
+                folder = self._wd_folder.pop(wd, None)
+                self._wd_path.pop(wd, None)
+                if folder is not None:
+                    self._folder_wds.get(folder, set()).discard(wd)
+                continue
+
+            folder = self._wd_folder.get(wd)
+            if folder is None:
+                continue
+            self._mark(folder)
+            # Новая подпапка (.rvt, Data или вложенная в Data) — наблюдение на её поддерево
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self._wd_path:
+                rewatch.add((folder, os.path.join(self._wd_path[wd], name)))
+
+        for folder, path in rewatch:
+            self._spawn(self._register_dir(folder, path))
+
+    async def changes(self):
+        loop = asyncio.get_running_loop()
+        if not self._reader_added:
+            loop.add_reader(self._fd, self._on_readable)
+            self._reader_added = True
+
+        # Первый полный проход инициализирует подписки и набор наблюдаемых папок
+        yield None
+        next_resync = time.monotonic() + self.resync_interval
+
+        while True:
+            timeout = max(0.0, next_resync - time.monotonic())
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            # Debounce: ждём тишины, но не дольше debounce_max от первого события
+            while self._first_event_at is not None:
+                now = time.monotonic()
+                quiet_until = self._last_event_at + self.debounce
+                hard_until = self._first_event_at + self.debounce_max
+                wait = min(quiet_until, hard_until) - now
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            self._event.clear()
+            self._first_event_at = None
+
+            if self._full_pending or time.monotonic() >= next_resync:
+                self._full_pending = False
+                self._pending.clear()
+                next_resync = time.monotonic() + self.resync_interval
+                yield None
+            elif self._pending:
+                folders, self._pending = self._pending, set()
+                yield folders
+
+    def close(self):
+        if self._fd < 0:
+            return
+        if self._reader_added:
+            try:
+                asyncio.get_running_loop().remove_reader(self._fd)
+            except RuntimeError:
+                pass
+            self._reader_added = False
+        for task in self._tasks:
+            task.cancel()
+        os.close(self._fd)
+        self._fd = -1
+
+
+def create_change_source(backend: str = WATCH_BACKEND) -> ChangeSource:
+    """Создаёт источник изменений по WATCH_BACKEND; при недоступности inotify — polling."""
+    if backend == "adaptive":
+        logger.info(
+            f"🗓 Источник изменений: адаптивный планировщик "
+            f"({SCHEDULE_MIN_INTERVAL:g}–{SCHEDULE_MAX_INTERVAL:g} с, {SCAN_BUDGET_PER_MINUTE} сканов/мин)"
+        )
+        return AdaptiveChangeSource()
+    if backend in ("inotify", "auto") and sys.platform.startswith("linux"):
+        try:
+            source = InotifyChangeSource()
+            logger.info("👁 Источник изменений: inotify")
+            return source
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify недоступен, используется polling: {e}")
+    elif backend == "inotify":
+        logger.warning("inotify поддерживается только в Linux, используется polling")
+    logger.info("⏲ Источник изменений: polling")
+    return PollingChangeSource()
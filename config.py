@@ -4,7 +4,120 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Свой сервер Bot API (например, локальный telegram-bot-api); пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./bot.db")
 FILES_ROOT = os.getenv("FILES_ROOT", "./files")
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "60"))
-ADMIN_IDS = ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS").split(",")]
\ No newline at end of file
+ADMIN_IDS = ADMIN_IDS = [int(id.strip()) for id in os.getenv("ADMIN_IDS").split(",")]
+
+# Сканирование файловой системы вне event loop
+SCAN_EXECUTOR = os.getenv("SCAN_EXECUTOR", "thread")  # thread | process
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "4"))
+SCAN_TIMEOUT = float(os.getenv("SCAN_TIMEOUT", "300"))
+
+# Инкрементальный индекс mtime папок Data (пустая строка — всегда полный обход).
+# Запись на месте в существующий файл (кроме .db3) mtime папки не меняет и
+# замечается только полным проходом раз в MTIME_INDEX_FULL_SCAN_INTERVAL секунд
+MTIME_INDEX_DIR = os.getenv("MTIME_INDEX_DIR", "./mtime_index")
+MTIME_INDEX_FULL_SCAN_INTERVAL = int(os.getenv("MTIME_INDEX_FULL_SCAN_INTERVAL", "900"))
+
+# Источник изменений: polling (периодический обход) | inotify (Linux) | auto
+# | adaptive (своё время проверки у каждой папки)
+WATCH_BACKEND = os.getenv("WATCH_BACKEND", "polling")
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "5"))
+WATCH_DEBOUNCE_MAX = float(os.getenv("WATCH_DEBOUNCE_MAX", "30"))
+WATCH_RESYNC_INTERVAL = int(os.getenv("WATCH_RESYNC_INTERVAL", "900"))
+
+# Адаптивный планировщик: интервал папки = возраст последнего изменения × SCHEDULE_AGE_FACTOR
+# в границах [SCHEDULE_MIN_INTERVAL, SCHEDULE_MAX_INTERVAL]; не больше SCAN_BUDGET_PER_MINUTE сканов в минуту
+SCHEDULE_MIN_INTERVAL = float(os.getenv("SCHEDULE_MIN_INTERVAL", str(CHECK_INTERVAL)))
+SCHEDULE_MAX_INTERVAL = float(os.getenv("SCHEDULE_MAX_INTERVAL", "10800"))
+SCHEDULE_AGE_FACTOR = float(os.getenv("SCHEDULE_AGE_FACTOR", "0.05"))
+SCAN_BUDGET_PER_MINUTE = int(os.getenv("SCAN_BUDGET_PER_MINUTE", "600"))
+
+# Подпапки Data, которые не обходятся при сканировании (без учёта регистра;
+# также пропускаются папки с суффиксом _backup)
+SCAN_PRUNE_DIRS = [d.strip().lower() for d in os.getenv("SCAN_PRUNE_DIRS", "backup,backups,revit_temp").split(",") if d.strip()]
+
+# Отпечаток содержимого задания для подтверждения изменений по mtime:
+# off — только mtime, manifest — (имя, размер, mtime_ns) файлов,
+# sample — плюс хэш выборки содержимого (FINGERPRINT_SAMPLE_BYTES с начала, середины и конца)
+FINGERPRINT_MODE = os.getenv("FINGERPRINT_MODE", "manifest")
+FINGERPRINT_SAMPLE_BYTES = int(os.getenv("FINGERPRINT_SAMPLE_BYTES", "4096"))
+FINGERPRINT_IGNORE = [p.strip().lower() for p in os.getenv("FINGERPRINT_IGNORE", "*.lock,*.tmp,~$*,*.bak,thumbs.db,desktop.ini").split(",") if p.strip()]
+
+# Кэш версий из Model.db3. MODEL_DB_IMMUTABLE=1 — чтение без блокировок
+# (immutable=1); применяется, только если рядом нет Model.db3-wal/-shm
+MODEL_HISTORY_CACHE_SIZE = int(os.getenv("MODEL_HISTORY_CACHE_SIZE", "256"))
+MODEL_DB_IMMUTABLE = os.getenv("MODEL_DB_IMMUTABLE", "0") == "1"
+
+# Очередь отправки уведомлений (лимиты Telegram: ~30 сообщений/с всего, 1/с в чат)
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", "4"))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "1000"))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", "1"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+
+# Дайджест: 0 — каждое изменение отдельным сообщением, cycle — одно сообщение
+# на пользователя за цикл проверки, число — окно группировки в секундах
+DIGEST_WINDOW = os.getenv("DIGEST_WINDOW", "0")
+
+# Кэш профилей пользователей для отправки уведомлений
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", "600"))
+PROFILE_REFRESH_TTL = int(os.getenv("PROFILE_REFRESH_TTL", "86400"))
+PROFILE_REFRESH_INTERVAL = int(os.getenv("PROFILE_REFRESH_INTERVAL", "60"))
+PROFILE_REFRESH_BATCH = int(os.getenv("PROFILE_REFRESH_BATCH", "50"))
+PROFILE_REFRESH_RATE = float(os.getenv("PROFILE_REFRESH_RATE", "5"))
+
+# Кэш дерева проектов/стадий/заданий для навигации /subscribe
+DIR_TREE_TTL = int(os.getenv("DIR_TREE_TTL", "600"))
+DIR_TREE_REFRESH_INTERVAL = int(os.getenv("DIR_TREE_REFRESH_INTERVAL", "60"))
+
+# Реестр пользователей: размер кэша и период пакетной записи изменений профиля
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_FLUSH_INTERVAL = int(os.getenv("USER_FLUSH_INTERVAL", "10"))
+
+# Профиль движка БД. SQLite: WAL, synchronous, ожидание блокировки (мс), mmap (байт).
+# PostgreSQL (DATABASE_URL=postgresql+asyncpg://..., нужен пакет asyncpg): пул соединений.
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Хранилище FSM: размер кэша в памяти, период записи в БД, срок жизни
+# состояния (секунды) и предельный размер данных одного пользователя (байт)
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_FLUSH_INTERVAL = int(os.getenv("FSM_FLUSH_INTERVAL", "10"))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(30 * 86400)))
+FSM_MAX_DATA_BYTES = int(os.getenv("FSM_MAX_DATA_BYTES", "1024"))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Несколько экземпляров на общей базе: роль процесса и шардирование папок заданий.
+# all — бот и наблюдение, bot — только хендлеры, watcher — только наблюдение.
+# При SHARDING_ENABLED=1 папки делятся консистентным хэшированием между живыми
+# воркерами (heartbeat в БД), а опрос Telegram ведёт один держатель аренды.
+INSTANCE_ROLE = os.getenv("INSTANCE_ROLE", "all")
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "0") == "1"
+WORKER_ID = os.getenv("WORKER_ID", "")
+SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", "10"))
+SHARD_LEASE_TTL = float(os.getenv("SHARD_LEASE_TTL", "30"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))
+
+# Журнал: запись в фоновом потоке через очередь (LOG_QUEUE_SIZE записей, лишние
+# отбрасываются), формат text | json, ротация по размеру (байт, 0 — нет) и по
+# времени (секунды, 0 — нет), архивы сжимаются в .gz, хранится LOG_BACKUP_COUNT
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", "86400"))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
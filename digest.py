@@ -0,0 +1,137 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime
+from config import DIGEST_WINDOW
+from utils import escape_clip, logger, utf16_len
+
+
+MAX_MESSAGE_LEN = 4096
+# Пределы полей пункта (в единицах UTF-16), чтобы один пункт всегда помещался в сообщение
+NAME_PREVIEW = 255
+PATH_PREVIEW = 1000
+COMMENT_PREVIEW = 1000
+
+
+@dataclass
+class ChangeItem:
+    """Одно обнаруженное изменение модели для конкретного подписчика."""
+    task_name: str
+    rvt_path: str
+    display_time: datetime
+    author: str
+    comment: str | None
+    outbox_id: int | None = None
+
+
+def format_change(item: ChangeItem) -> str:
+    comment_line = f"📝 Комментарий: {escape_clip(item.comment, COMMENT_PREVIEW)}" if item.comment else ""
+    return (
+        "🔄 <b>Обнаружено изменение в подписанной папке!</b>\n\n"
+        f"📂 Подписка: <b>{escape_clip(item.task_name, NAME_PREVIEW)}</b>\n"
+        f"📌 Путь: <code>{escape_clip(item.rvt_path, PATH_PREVIEW)}</code>\n"
+        f"🕒 Время изменения: {item.display_time.strftime('%d.%m.%Y %H:%M')}\n"
+        f"{comment_line}\n"
+        f"👤 Автор - {escape_clip(item.author, NAME_PREVIEW)}\n"
+    )
+
+
+def format_digest(items: list[ChangeItem]) -> list[tuple[str, list[ChangeItem]]]:
+    """
+    Сводка по нескольким изменениям. Возвращает список (текст, пункты): если
+    текст не помещается в лимит Telegram, он делится по границам пунктов,
+    и заголовок повторяется в каждой части. Длина считается в UTF-16, как в Telegram.
+    """
+    if len(items) == 1:
+        return [(format_change(items[0]), items)]
+
+    def header(part: int, parts: int) -> str:
+        suffix = f" — часть {part}/{parts}" if parts > 1 else ""
+        return f"🔄 <b>Обнаружены изменения в подписанных папках ({len(items)})</b>{suffix}\n\n"
+
+    blocks = []
+    for item in sorted(items, key=lambda i: (i.task_name, i.display_time)):
+        block = (
+            f"📂 <b>{escape_clip(item.task_name, NAME_PREVIEW)}</b>\n"
+            f"📌 <code>{escape_clip(item.rvt_path, PATH_PREVIEW)}</code>\n"
+            f"🕒 {item.display_time.strftime('%d.%m.%Y %H:%M')} 👤 {escape_clip(item.author, NAME_PREVIEW)}\n"
+        )
+        if item.comment:
+            block += f"📝 {escape_clip(item.comment, COMMENT_PREVIEW)}\n"
+        blocks.append((block + "\n", item))
+
+    # Место под самый длинный заголовок: частей не больше, чем пунктов
+    budget = MAX_MESSAGE_LEN - utf16_len(header(len(items), len(items)))
+    chunks = []
+    current, used, current_items = "", 0, []
+    for block, item in blocks:
+        size = utf16_len(block)
+        if used + size > budget and current_items:
+            chunks.append((current, current_items))
+            current, used, current_items = "", 0, []
+        current += block
+        used += size
+        current_items.append(item)
+    chunks.append((current, current_items))
+    return [(header(i, len(chunks)) + text, chunk_items) for i, (text, chunk_items) in enumerate(chunks, 1)]
+
+
+def _outbox_ids(items: list[ChangeItem]) -> list[int]:
+    return [item.outbox_id for item in items if item.outbox_id is not None]
+
+
+def parse_digest_window(value: str) -> float | str | None:
+    """'0' — дайджест выключен, 'cycle' — по циклу проверки, иначе окно в секундах."""
+    if value == "cycle":
+        return "cycle"
+    window = float(value)
+    return window if window > 0 else None
+
+
+class DigestCollector:
+    """
+    Копит изменения по пользователям и отправляет их одним сообщением:
+    либо через window секунд после первого изменения, либо по flush()
+    в конце цикла проверки (window == 'cycle').
+    """
+
+    def __init__(self, send, window: float | str | None = parse_digest_window(DIGEST_WINDOW)):
+        self.send = send
+        self.window = window
+        self._pending: dict[int, list[ChangeItem]] = {}
+        self._timers: dict[int, asyncio.Task] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.window is not None
+
+    async def add(self, chat_id: int, item: ChangeItem):
+        if not self.enabled:
+            await self.send(chat_id, format_change(item), _outbox_ids([item]))
+            return
+        self._pending.setdefault(chat_id, []).append(item)
+        if self.window != "cycle" and chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._timers.pop(chat_id, None)
+        await self._flush_chat(chat_id)
+
+    async def _flush_chat(self, chat_id: int):
+        items = self._pending.pop(chat_id, [])
+        if not items:
+            return
+        for text, chunk in format_digest(items):
+            await self.send(chat_id, text, _outbox_ids(chunk))
+        if len(items) > 1:
+            logger.info(f"🗞 Дайджест из {len(items)} изменений для {chat_id}")
+
+    async def flush(self):
+        """Отправляет всё накопленное (конец цикла проверки или остановка)."""
+        for task in list(self._timers.values()):
+            task.cancel()
+        self._timers.clear()
+        for chat_id in list(self._pending):
+            await self._flush_chat(chat_id)
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from config import FILES_ROOT, DIR_TREE_TTL, DIR_TREE_REFRESH_INTERVAL
+from scanner import ScanTimeout, scan_executor
+from utils import logger
+
+
+# Глубина навигации: проекты (0) → стадии (1) → задания (2)
+TREE_DEPTH = 3
+EXCLUDED_STAGES = {"bim"}
+
+
+def list_subdirs(full_path: str, depth: int, deadline: float | None = None) -> tuple[int, list[str]] | None:
+    """mtime_ns папки и отсортированный список её подпапок; None — папки нет."""
+    try:
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        with os.scandir(full_path) as it:
+            names = [entry.name for entry in it if entry.is_dir()]
+    except OSError:
+        return None
+    if depth == 1:
+        names = [name for name in names if name.lower() not in EXCLUDED_STAGES]
+    return mtime_ns, sorted(names)
+
+
+def refresh_tree(root: str, entries: dict, ttl: float, deadline: float | None = None) -> dict:
+    """
+    Обходит три уровня дерева. Папка перечитывается, только если изменилось её
+    mtime или запись старше ttl; иначе стоит один stat. Возвращает новый словарь
+    {относительный путь: (mtime_ns, время загрузки, подпапки)}.
+    """
+    now = time.time()
+    fresh = {}
+    stack = [("", 0)]
+    while stack:
+        if deadline is not None and time.monotonic() > deadline:
+            raise ScanTimeout()
+        rel_path, depth = stack.pop()
+        full_path = os.path.join(root, rel_path) if rel_path else root
+        cached = entries.get(rel_path)
+        try:
+            mtime_ns = os.stat(full_path).st_mtime_ns
+        except OSError:
+            continue
+        if cached is not None and cached[0] == mtime_ns and now - cached[1] < ttl:
+            fresh[rel_path] = cached
+        else:
+            listing = list_subdirs(full_path, depth)
+            if listing is None:
+                continue
+            fresh[rel_path] = (listing[0], now, listing[1])
+        if depth + 1 < TREE_DEPTH:
+            for name in fresh[rel_path][2]:
+                stack.append((os.path.join(rel_path, name) if rel_path else name, depth + 1))
+    return fresh
+
+
+class DirectoryTreeCache:
+    """
+    Общий для всех пользователей кэш дерева FILES_ROOT. Обновляется в фоне в
+    пуле сканирования, хендлеры читают только память. Единственное обращение к
+    диску из хендлера — первая загрузка узла, которого ещё нет в кэше, и оно
+    тоже выполняется вне event loop.
+    """
+
+    def __init__(self, root: str = FILES_ROOT, ttl: float = DIR_TREE_TTL,
+                 refresh_interval: float = DIR_TREE_REFRESH_INTERVAL):
+        self.root = root
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self._entries: dict[str, tuple[int, float, list[str]]] = {}
+        self._listeners: list = []
+        self._task: asyncio.Task | None = None
+
+    def add_listener(self, listener):
+        """listener(old, new) вызывается после каждого обновления словаря узлов."""
+        self._listeners.append(listener)
+
+    def _replace(self, entries: dict):
+        old, self._entries = self._entries, entries
+        for listener in self._listeners:
+            try:
+                listener(old, entries)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика обновления дерева папок: {e}")
+
+    async def refresh(self):
+        self._replace(await scan_executor.run(refresh_tree, self.root, self._entries, self.ttl))
+
+    async def children(self, *parts: str) -> list[str]:
+        """Подпапки узла: () — проекты, (project,) — стадии, (project, stage) — задания."""
+        rel_path = os.path.join(*parts) if parts else ""
+        cached = self._entries.get(rel_path)
+        if cached is not None:
+            return cached[2]
+        listing = await scan_executor.run(list_subdirs, os.path.join(self.root, rel_path), len(parts))
+        if listing is None:
+            return []
+        entries = dict(self._entries)
+        entries[rel_path] = (listing[0], time.time(), listing[1])
+        self._replace(entries)
+        return listing[1]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                started = time.monotonic()
+                await self.refresh()
+                logger.debug(f"🌳 Дерево папок обновлено за {time.monotonic() - started:.2f} с")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обновления дерева папок: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+dir_tree = DirectoryTreeCache()
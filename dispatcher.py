@@ -0,0 +1,226 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNotFound,
+    TelegramRetryAfter, TelegramUnauthorizedError,
+)
+from config import (
+    NOTIFY_WORKERS, NOTIFY_QUEUE_SIZE, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES,
+)
+from metrics import (
+    notify_queue_depth, notify_send_seconds, notify_lag_seconds, notify_sent_total, notify_errors_total,
+)
+from utils import log_fields, logger
+
+
+# Ошибки, после которых повтор бессмыслен: бот заблокирован, чат не найден, кривой HTML
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound, TelegramUnauthorizedError)
+CHAT_BUCKET_IDLE_TTL = 60
+
+
+class TokenBucket:
+    """
+    Token bucket с резервированием: acquire() сразу занимает токен (баланс может
+    уйти в минус) и спит, пока он не накопится. Так конкурентные воркеры
+    выстраиваются в очередь, а не опрашивают ведро наперегонки.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def delay(self) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Отодвигает выдачу токенов (ответ 429 с retry_after)."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class Notification:
+    chat_id: int
+    text: str
+    outbox_ids: list[int] = field(default_factory=list)
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class NotificationDispatcher:
+    """
+    Асинхронная очередь уведомлений с пулом воркеров. Отправка ограничена
+    общим token bucket и отдельным для каждого чата; на TelegramRetryAfter
+    воркер ждёт указанное время, сетевые ошибки повторяются с экспоненциальной
+    задержкой.
+    У каждого чата своя очередь; воркеры берут только чаты, у которых уже есть
+    токен, так что чат с длинной очередью не занимает воркеров ожиданием своего
+    лимита 1 сообщение/с. Сообщения одного чата уходят по порядку, по одному.
+    Очередь ограничена: при переполнении enqueue() ждёт (backpressure).
+    После доставки (или окончательного отказа) вызывается on_done(outbox_ids).
+    """
+
+    def __init__(self, bot: Bot, workers: int = NOTIFY_WORKERS, queue_size: int = NOTIFY_QUEUE_SIZE,
+                 global_rate: float = NOTIFY_GLOBAL_RATE, chat_rate: float = NOTIFY_CHAT_RATE,
+                 max_retries: int = NOTIFY_MAX_RETRIES, on_done=None):
+        self.bot = bot
+        self.on_done = on_done
+        self.workers = max(1, workers)
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        # Чат есть в _pending, пока у него есть сообщения: он либо ждёт токена,
+        # либо стоит в _ready, либо его сообщение отправляет воркер
+        self._pending: dict[int, deque[Notification]] = {}
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max(1, queue_size))
+        self._size = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._last_prune = time.monotonic()
+        self.sent = 0
+        self.failed = 0
+        notify_queue_depth.set_function(self.qsize)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"📨 Очередь уведомлений запущена: {self.workers} воркеров")
+
+    def qsize(self) -> int:
+        return self._size
+
+    async def enqueue(self, chat_id: int, text: str, outbox_ids=()):
+        await self._slots.acquire()
+        self._size += 1
+        self._drained.clear()
+        item = Notification(chat_id, text, list(outbox_ids))
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            self._pending[chat_id] = deque([item])
+            self._schedule(chat_id)
+        else:
+            pending.append(item)
+
+    async def join(self):
+        """Ждёт, пока все поставленные уведомления не будут обработаны."""
+        await self._drained.wait()
+
+    def _schedule(self, chat_id: int):
+        """Отдаёт чат воркерам, когда у него появится токен."""
+        delay = self._chat_bucket(chat_id).delay()
+        if delay <= 0:
+            self._ready.put_nowait(chat_id)
+        else:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._last_prune > CHAT_BUCKET_IDLE_TTL:
+            self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle}
+            self._last_prune = now
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            pending = self._pending[chat_id]
+            item = pending.popleft()
+            try:
+                with log_fields(chat_id=item.chat_id, outbox_ids=item.outbox_ids):
+                    if await self._deliver(item) and self.on_done is not None and item.outbox_ids:
+                        self.on_done(item.outbox_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в воркере уведомлений: {e}")
+            finally:
+                self._size -= 1
+                self._slots.release()
+                if not self._size:
+                    self._drained.set()
+                if pending:
+                    self._schedule(chat_id)
+                else:
+                    del self._pending[chat_id]
+
+    async def _deliver(self, item: Notification) -> bool:
+        """
+        Отправляет сообщение с повторами. True — судьба сообщения решена (доставлено
+        или отказ окончательный), False — исчерпаны повторы временных ошибок,
+        запись outbox остаётся для повторной отправки после перезапуска.
+        """
+        while True:
+            await self._chat_bucket(item.chat_id).acquire()
+            await self.global_bucket.acquire()
+            started = time.perf_counter()
+            try:
+                await self.bot.send_message(chat_id=item.chat_id, text=item.text, parse_mode="HTML")
+                notify_send_seconds.observe(time.perf_counter() - started)
+                notify_lag_seconds.observe(time.monotonic() - item.enqueued_at)
+                notify_sent_total.inc()
+                self.sent += 1
+                logger.info(f"✅ Уведомление отправлено {item.chat_id}")
+                return True
+            except TelegramRetryAfter as e:
+                # Flood control касается всего бота — притормаживаем и общий, и чатовый поток
+                notify_errors_total.inc(kind="retry_after")
+                logger.warning(f"⏳ Flood control, повтор через {e.retry_after} с ({item.chat_id})")
+                self.global_bucket.pause(e.retry_after)
+                self._chat_bucket(item.chat_id).pause(e.retry_after)
+            except PERMANENT_ERRORS as e:
+                notify_errors_total.inc(kind="permanent")
+                self.failed += 1
+                logger.error(f"Уведомление для {item.chat_id} не доставлено: {e}")
+                return True
+            except Exception as e:
+                notify_errors_total.inc(kind="transient")
+                item.attempts += 1
+                if item.attempts > self.max_retries:
+                    self.failed += 1
+                    logger.error(f"Уведомление для {item.chat_id} не доставлено после {self.max_retries} попыток: {e}")
+                    return False
+                delay = min(60, 2 ** item.attempts)
+                logger.warning(f"Ошибка отправки {item.chat_id}, повтор через {delay} с: {e}")
+                await asyncio.sleep(delay)
+
+    async def close(self, timeout: float = 10):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеров."""
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не отправлено уведомлений при остановке: {self.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -1,231 +1,413 @@
 import asyncio
+import itertools
 import os
-import aiosqlite
-from sqlalchemy import select
-from models import FolderSubscription, User, async_session
+import time
+from sqlalchemy import bindparam, delete, select, update
+from models import FolderSubscription, NotificationOutbox, async_session
 from aiogram import Bot
-from config import FILES_ROOT, CHECK_INTERVAL
+from config import FILES_ROOT, FINGERPRINT_MODE, FINGERPRINT_SAMPLE_BYTES
 from datetime import datetime, timedelta
-from utils import logger
+from utils import bot_session, log_fields, logger
+from model_history import model_history
+from dispatcher import NotificationDispatcher
+from digest import ChangeItem, DigestCollector
+from user_profiles import ProfileRefresher, UserProfile, UserProfileCache
+from change_sources import create_change_source
+from scanner import ScanTimeout, locate_db_file, scan_executor, scan_task_folder
+from fingerprint import fingerprint_changed, task_fingerprint
+from sharding import ShardCoordinator
+from metrics import (
+    scan_cycle_seconds, task_scan_seconds, scan_dirs_total, scan_stat_calls_total,
+    scan_errors_total, subscribed_folders,
+)
 
 
 DISPLAY_TIME_OFFSET_MINUTES = 60
 
 
 class FileWatcher:
-    def __init__(self, bot_token: str):
+    def __init__(self, bot_token: str, shard: ShardCoordinator | None = None):
         self.bot_token = bot_token
-        self.bot = Bot(token=bot_token)
+        # При шардировании воркер проверяет только свои папки
+        self.shard = shard
+        self._owned: set[str] = set()
+        self.bot = Bot(token=bot_token, session=bot_session())
+        self.change_source = create_change_source()
+        self.dispatcher = NotificationDispatcher(self.bot, on_done=self.ack_outbox)
+        self.digest = DigestCollector(self.dispatcher.enqueue)
+        self.profiles = UserProfileCache()
+        self.profile_refresher = ProfileRefresher(self.bot, self.profiles)
+        self._acked_outbox: list[int] = []
+        # Записи outbox, поставленные в очередь этим процессом и ещё не удалённые из БД
+        self._queued_outbox: set[int] = set()
+        self._replay_task: asyncio.Task | None = None
+        self._cycles = itertools.count(1)
 
     def get_full_path(self, relative_path: str) -> str:
         """Конструирует абсолютный путь из относительного (относительно FILES_ROOT)."""
         return os.path.join(FILES_ROOT, relative_path)
 
-    def get_folder_mtime_recursive(self, folder_path: str) -> float:
+    async def get_comment_and_user(self, db: str):
+        """Последняя запись ModelHistory; результат кэшируется по размеру и mtime файла."""
+        return await model_history.get(db)
+
+    async def find_db_file(self, dir: str, db_path: str | None = None):
         """
-        Рекурсивно возвращает самое свежее время изменения в папке.
-        Если папки нет — возвращает 0.0.
+        Читает последнюю версию из Model.db3. Путь обычно уже известен из
+        сканирования; повторный обход папки Data — только если его нет.
         """
-        if not os.path.exists(folder_path):
-            return 0.0
-        latest = 0.0
         try:
-            for root, _, files in os.walk(folder_path):
-                try:
-                    mtime = os.path.getmtime(root)
-                    if mtime > latest:
-                        latest = mtime
-                except OSError:
-                    pass
-                for file in files:
-                    try:
-                        mtime = os.path.getmtime(os.path.join(root, file))
-                        if mtime > latest:
-                            latest = mtime
-                    except OSError:
-                        pass
-        except Exception as e:
-            logger.warning(f"Ошибка при сканировании {folder_path}: {e}")
-        return latest
-    
-    async def get_comment_and_user(self, db: str):
-        try:
-            async with aiosqlite.connect(db) as conn:
-                cursor = await conn.cursor()
-                
-                await cursor.execute(
-                    "SELECT VersionNumber, Comment, UserName FROM ModelHistory ORDER BY VersionNumber DESC LIMIT 1"
-                )
-                rows = await cursor.fetchone()
-                
-                if rows:
-                    return rows
-                    
-        except aiosqlite.Error as e:
-            logger.error(f"SQLite error: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error in get_comment: {e}")
-        
-        return None
+            if db_path is None:
+                db_path = await scan_executor.run(locate_db_file, dir)
+            if db_path:
+                logger.info(f"Найден Models.db3: {db_path}")
+
+                comment = await self.get_comment_and_user(db_path)
+                if comment and len(comment) >= 2:
+                    return comment
+                else:
+                    return "неизвестно", "нет комментария"
 
-    async def find_db_file(self, dir: str):
-        try:
-            for root, dirs, files in os.walk(dir):
-                for file in files:
-                    if file == 'Model.db3':
-                        db_path = os.path.join(root, file)
-                        logger.info(f"Найден Models.db3: {db_path}")
-                        
-                        comment = await self.get_comment_and_user(db_path)
-                        if comment and len(comment) >= 2:
-                            return comment  
-                        else:
-                            return "неизвестно", "нет комментария"
-                            
-                await asyncio.sleep(0)
-                        
         except Exception as e:
             logger.error(f"Error in find_db_file: {e}")
-        
+
         logger.warning(f"Models.db3 не найден в {dir}")
         return "неизвестно", "нет комментария"
 
 
-    async def notify_subscribers(self, sub: FolderSubscription, changed_data_path: str, current_mtime: datetime):
+    async def notify_subscribers(self, entry: NotificationOutbox, profile: UserProfile | None = None):
         """
         Отправляет уведомление подписчику о изменении в конкретной папке Data.
+        Профиль берётся из кэша; обновление данных из Telegram идёт в фоне.
         """
         try:
-            async with async_session() as session:
-                result = await session.execute(select(User).where(User.id == sub.user_id))
-                user = result.scalar_one_or_none()
-                if not user:
-                    logger.warning(f"Пользователь с ID {sub.user_id} не найден")
-                    return
-                
-                try:
-                    tg_user = await self.bot.get_chat(user.tg_id)
-                    user.username = tg_user.username
-                    user.first_name = tg_user.first_name
-                    await session.commit()
-                    logger.debug(f"Обновлены данные пользователя {user.tg_id} {tg_user.username} {tg_user.first_name}")
-                except Exception as e:
-                    logger.warning(f"Не удалось обновить данные пользователя {user.tg_id}: {e}")
+            if profile is None:
+                async with async_session() as session:
+                    profile = (await self.profiles.resolve(session, [entry.user_id])).get(entry.user_id)
+            if not profile:
+                logger.warning(f"Пользователь с ID {entry.user_id} не найден")
+                self.ack_outbox([entry.id])
+                return
+            self.profile_refresher.request(profile)
 
             # Папка "Задание", на которую подписан пользователь (относительно FILES_ROOT)
-            task_relative = sub.folder_path                          # например: "355/РД/Задание от КЖ"
+            task_relative = entry.folder_path                          # например: "355/РД/Задание от КЖ"
             task_name = os.path.basename(task_relative)              # например: "Задание от КЖ"
 
             # Путь до изменившейся .rvt-папки БЕЗ "Data"
-            rel_path = os.path.relpath(changed_data_path, FILES_ROOT)  # ".../.rvt/Data"
+            rel_path = os.path.relpath(entry.data_path, FILES_ROOT)  # ".../.rvt/Data"
             rvt_path = os.path.dirname(rel_path)                        # убираем "Data": ".../.rvt"
 
             # Время для отображения (со сдвигом), в БД/логах остаётся исходное
-            display_time = current_mtime + timedelta(minutes=DISPLAY_TIME_OFFSET_MINUTES)
+            display_time = entry.changed_at + timedelta(minutes=DISPLAY_TIME_OFFSET_MINUTES)
 
-            comment_result = await self.find_db_file(changed_data_path)
-            comment_line = ""
-            user_line = ""
-            
-            if comment_result and len(comment_result) >= 2:
+            comment_result = await self.find_db_file(entry.data_path, entry.db_path)
+            comment_text = None
+            user_text = "неизвестно"
+
+            if comment_result and len(comment_result) >= 3:
                 comment_text = comment_result[1]
                 user_text = comment_result[2]
-                if comment_text and comment_text.strip() and comment_text != "нет комментария":
-                    comment_line = f"📝 Комментарий: {comment_text}"
+                if not comment_text or not comment_text.strip() or comment_text == "нет комментария":
+                    comment_text = None
             else:
                 logger.error("Комментарий не получен или имеет неверный формат")
 
-            message = (
-                "🔄 <b>Обнаружено изменение в подписанной папке!</b>\n\n"
-                f"📂 Подписка: <b>{task_name}</b>\n"
-                f"📌 Путь: <code>{rvt_path}</code>\n"
-                f"🕒 Время изменения: {display_time.strftime('%d.%m.%Y %H:%M')}\n"
-                f"{comment_line}\n"
-                f"👤 Автор - {user_text}\n"
-            )
-
-            await self.bot.send_message(
-                chat_id=user.tg_id,
-                text=message,
-                parse_mode="HTML"
-            )
-            logger.info(f"✅ Уведомление отправлено пользователю {user.first_name} {user.username} {user.tg_id} ({task_relative})")
+            item = ChangeItem(task_name, rvt_path, display_time, user_text, comment_text, entry.id)
+            await self.digest.add(profile.tg_id, item)
+            logger.info(f"📨 Уведомление поставлено в очередь для {profile.first_name} {profile.username} {profile.tg_id} ({task_relative})")
 
         except Exception as e:
+            # Запись осталась в outbox — её дошлёт повторная отправка
+            self._queued_outbox.discard(entry.id)
             logger.error(f"Ошибка при отправке уведомления: {e}")
 
 
-    async def check_folder_updates(self, session):
+    def plan_scans(self, subscriptions) -> dict[str, list[FolderSubscription]]:
+        """
+        Группирует подписки по папке задания, чтобы каждая папка сканировалась
+        один раз за цикл независимо от числа подписчиков.
+        """
+        plan: dict[str, list[FolderSubscription]] = {}
+        for sub in subscriptions:
+            plan.setdefault(sub.folder_path, []).append(sub)
+        return plan
+
+    async def fingerprint_folders(self, folders: list[str]) -> dict[str, str | None]:
+        """
+        Отпечатки папок, где mtime показал возможное изменение. Считаются только
+        для таких папок, поэтому в спокойном цикле стоимость не меняется.
+        """
+        if FINGERPRINT_MODE == "off" or not folders:
+            return {}
+        sample_bytes = FINGERPRINT_SAMPLE_BYTES if FINGERPRINT_MODE == "sample" else 0
+        results = await asyncio.gather(*(
+            scan_executor.run(task_fingerprint, self.get_full_path(folder_path), sample_bytes)
+            for folder_path in folders
+        ), return_exceptions=True)
+        fingerprints = {}
+        for folder_path, result in zip(folders, results):
+            if isinstance(result, Exception):
+                # Без отпечатка решение принимается по mtime, как раньше
+                logger.warning(f"Не удалось вычислить отпечаток {folder_path}: {result!r}")
+                result = None
+            fingerprints[folder_path] = result
+        return fingerprints
+
+    async def check_folder_updates(self, session, folders: set[str] | None = None):
         """
         Для каждой подписанной папки 'Задание' проверяет все подпапки (например 1.rvt, 2.rvt, ...)
-        и ищет в них папку 'Data'. Если в какой-то Data есть изменения — уведомляет подписчика.
+        и ищет в них папку 'Data'. Если в какой-то Data есть изменения — уведомляет подписчиков.
+        Каждая папка сканируется один раз, результат раздаётся всем её подписчикам.
+        Изменение по mtime подтверждается отпечатком содержимого (last_hash), если он включён.
+        Если передан folders — проверяются только эти папки.
         """
+        started = time.perf_counter()
         try:
             result = await session.execute(select(FolderSubscription))
             subscriptions = result.scalars().all()
 
-            for sub in subscriptions:
-                task_full_path = self.get_full_path(sub.folder_path)  # Путь до папки Задание
+            plan = self.plan_scans(subscriptions)
+            if self.shard is not None:
+                plan = {folder: subs for folder, subs in plan.items() if self.shard.owns(folder)}
+                await self.take_over(set(plan))
+            subscribed_folders.set(len(plan))
+            self.change_source.update_folders(set(plan))
+            if folders is not None:
+                plan = {folder: subs for folder, subs in plan.items() if folder in folders}
+            # Папки заданий сканируются параллельно в пуле, event loop остаётся свободным
+            scans = await asyncio.gather(*(
+                scan_executor.run(scan_task_folder, self.get_full_path(folder_path))
+                for folder_path in plan
+            ), return_exceptions=True)
+
+            scanned = {}
+            for (folder_path, subs), scan in zip(plan.items(), scans):
+                task_full_path = self.get_full_path(folder_path)  # Путь до папки Задание
 
-                if not os.path.exists(task_full_path):
+                if isinstance(scan, ScanTimeout):
+                    scan_errors_total.inc(kind="timeout")
+                    logger.warning(f"⏱ Превышено время сканирования: {task_full_path}")
+                    continue
+                if isinstance(scan, Exception):
+                    scan_errors_total.inc(kind="error")
+                    logger.error(f"Ошибка при сканировании {task_full_path}: {scan}")
+                    continue
+                if scan is None:
+                    scan_errors_total.inc(kind="missing")
                     logger.warning(f"Папка задания не найдена: {task_full_path}")
                     continue
 
-                subfolders = [name for name in os.listdir(task_full_path)
-                              if os.path.isdir(os.path.join(task_full_path, name))]
-
-                latest_mtime_ts = 0.0
-                changed_data_folder = None
+                task_scan_seconds.observe(scan.duration)
+                scan_dirs_total.inc(scan.dirs)
+                scan_stat_calls_total.inc(scan.stat_calls)
+                # Планировщик подстраивает срок следующей проверки под активность папки
+                self.change_source.record_scan(folder_path, scan.latest_mtime or None)
+                if scan.latest_mtime == 0.0:
+                    continue
 
-                for subfolder in subfolders:
-                    data_folder_path = os.path.join(task_full_path, subfolder, "Data")
-                    if not os.path.exists(data_folder_path) or not os.path.isdir(data_folder_path):
-                        continue
+                # Подписки, для которых mtime показал новое состояние папки
+                changed = [
+                    sub for sub in subs
+                    if sub.last_modified is None
+                    # Сравнение с точностью до секунды
+                    or int(scan.latest_mtime) > int(sub.last_modified.timestamp())
+                ]
+                if changed:
+                    scanned[folder_path] = (scan, changed)
 
-                    current_mtime_ts = self.get_folder_mtime_recursive(data_folder_path)
-                    if current_mtime_ts > latest_mtime_ts:
-                        latest_mtime_ts = current_mtime_ts
-                        changed_data_folder = data_folder_path
+            fingerprints = await self.fingerprint_folders(list(scanned))
 
-                if latest_mtime_ts == 0.0:
+            updates = []
+            outbox = []
+            for folder_path, (scan, subs) in scanned.items():
+                if self.shard is not None and not self.shard.owns(folder_path):
+                    # За время скана папка переехала к другому воркеру — решать ему
                     continue
-
+                latest_mtime_ts, changed_data_folder, db_path = scan.latest_mtime, scan.data_folder, scan.db_path
                 current_mtime = datetime.fromtimestamp(latest_mtime_ts)
+                fingerprint = fingerprints.get(folder_path)
 
-                if sub.last_modified is None:
-                    sub.last_modified = current_mtime
-                    session.add(sub)
-                    await session.commit()
-                    logger.info(f"📌 Инициализация времени изменения для {sub.folder_path}")
-                    continue
+                for sub in subs:
+                    update_row = {
+                        "sub_id": sub.id, "last_modified": current_mtime,
+                        "last_hash": sub.last_hash if fingerprint is None else fingerprint,
+                    }
+
+                    if sub.last_modified is None:
+                        updates.append(update_row)
+                        logger.info(f"📌 Инициализация времени изменения для {sub.folder_path}")
+                        continue
+
+                    if fingerprint is not None and not fingerprint_changed(sub.last_hash, fingerprint):
+                        # mtime сдвинулся, а содержимое нет: блокировки, антивирус, бэкап
+                        updates.append(update_row)
+                        logger.info(f"🔕 Изменение без изменения содержимого пропущено: {sub.folder_path}")
+                        continue
 
-                # Сравнение с точностью до секунды
-                if int(latest_mtime_ts) > int(sub.last_modified.timestamp()):
                     logger.info(f"🔥 Обнаружено изменение в Data: {changed_data_folder}")
-                    sub.last_modified = current_mtime
-                    session.add(sub)
-                    await session.commit()
-                    await self.notify_subscribers(sub, changed_data_folder, current_mtime)
+                    updates.append(update_row)
+                    outbox.append((sub.id, NotificationOutbox(
+                        user_id=sub.user_id,
+                        folder_path=sub.folder_path,
+                        data_path=changed_data_folder,
+                        db_path=db_path,
+                        changed_at=current_mtime,
+                    )))
+
+            if not updates:
+                return
+
+            # Подписки, удалённые за время скана (delete_sub), пропускаем: ни сдвига, ни уведомления
+            existing = set((await session.execute(
+                select(FolderSubscription.id).where(FolderSubscription.id.in_([row["sub_id"] for row in updates]))
+            )).scalars())
+            updates = [row for row in updates if row["sub_id"] in existing]
+            outbox = [entry for sub_id, entry in outbox if sub_id in existing]
+            if not updates:
+                return
+
+            # Все сдвиги last_modified и уведомления цикла — одной транзакцией. Core-UPDATE
+            # пакетом не сверяет число строк, так что удалённая строка не откатит весь цикл
+            subscriptions_table = FolderSubscription.__table__
+            await session.execute(
+                update(subscriptions_table)
+                .where(subscriptions_table.c.id == bindparam("sub_id"))
+                .values(last_modified=bindparam("last_modified"), last_hash=bindparam("last_hash")),
+                updates,
+            )
+            session.add_all(outbox)
+            await session.commit()
+
+            # Отправка только после успешного коммита
+            await self.deliver_outbox(session, outbox)
 
         except Exception as e:
             logger.error(f"Ошибка при проверке обновлений Data: {e}")
+        finally:
+            # В режиме дайджеста по циклу всё найденное за проход уходит одним сообщением
+            if self.digest.window == "cycle":
+                await self.digest.flush()
+            scan_cycle_seconds.observe(time.perf_counter() - started)
 
-    async def start_monitoring(self):
-        """Периодически проверяет все подписки."""
-        logger.info("🚀 Мониторинг подписок запущен...")
+    async def deliver_outbox(self, session, entries: list[NotificationOutbox]):
+        """Ставит записи outbox в очередь; профили получателей — одним запросом."""
+        self._queued_outbox.update(entry.id for entry in entries)
+        profiles = await self.profiles.resolve(session, [entry.user_id for entry in entries])
+        for entry in entries:
+            await self.notify_subscribers(entry, profiles.get(entry.user_id))
+
+    def ack_outbox(self, outbox_ids):
+        """Помечает записи outbox доставленными; удаляются пачкой в flush_outbox_acks()."""
+        self._acked_outbox.extend(outbox_ids)
+
+    async def flush_outbox_acks(self):
+        if not self._acked_outbox:
+            return
+        acked, self._acked_outbox = self._acked_outbox, []
+        try:
+            async with async_session() as session:
+                await session.execute(delete(NotificationOutbox).where(NotificationOutbox.id.in_(acked)))
+                await session.commit()
+        except Exception as e:
+            self._acked_outbox.extend(acked)
+            logger.error(f"Не удалось очистить outbox: {e}")
+            return
+        self._queued_outbox.difference_update(acked)
+
+    async def take_over(self, owned: set[str]):
+        """
+        Папки, доставшиеся воркеру при перебалансировке: досылает их записи
+        outbox, брошенные прежним владельцем. Записи моложе SHARD_LEASE_TTL
+        не трогаем — прежний владелец может ещё отправлять их сам.
+        """
+        acquired = owned - self._owned
+        self._owned = owned
+        if not acquired:
+            return
+        cutoff = datetime.utcnow() - timedelta(seconds=self.shard.lease_ttl)
+        try:
+            await self.replay_outbox(acquired, cutoff)
+        except Exception as e:
+            logger.error(f"Ошибка при повторной отправке outbox: {e}")
+
+    async def replay_outbox(self, folders: set[str] | None = None, created_before: datetime | None = None):
+        """
+        Досылает уведомления, оставшиеся в outbox после прошлого запуска (или
+        прежнего владельца папок). Записи, уже стоящие в очереди этого процесса, пропускаются.
+        """
+        query = select(NotificationOutbox).order_by(NotificationOutbox.id)
+        if created_before is not None:
+            query = query.where(NotificationOutbox.created_at < created_before)
+        async with async_session() as session:
+            result = await session.execute(query)
+            entries = result.scalars().all()
+            entries = [
+                entry for entry in entries
+                if entry.id not in self._queued_outbox and (folders is None or entry.folder_path in folders)
+            ]
+            if entries:
+                logger.info(f"📮 Повторная отправка уведомлений из outbox: {len(entries)}")
+                await self.deliver_outbox(session, entries)
+        if self.digest.window == "cycle":
+            await self.digest.flush()
+
+    async def _replay_owned(self):
+        """
+        Раз в интервал heartbeat досылает записи outbox своих папок старше
+        SHARD_LEASE_TTL. Так не теряются уведомления, которые воркер не успел
+        отправить перед перезапуском: take_over после рестарта пропускает их
+        как слишком свежие, а других владельцев у папок нет.
+        """
         while True:
+            await asyncio.sleep(self.shard.heartbeat_interval)
+            owned = {folder for folder in self._owned if self.shard.owns(folder)}
+            if not owned:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=self.shard.lease_ttl)
             try:
-                async with async_session() as session:
-                    await self.check_folder_updates(session)
-                await asyncio.sleep(CHECK_INTERVAL)
-            except asyncio.CancelledError:
-                logger.info("🛑 Мониторинг остановлен.")
-                break
+                await self.flush_outbox_acks()
+                await self.replay_outbox(owned, cutoff)
             except Exception as e:
-                logger.error(f"Ошибка в цикле мониторинга: {e}")
-                await asyncio.sleep(CHECK_INTERVAL)
+                logger.error(f"Ошибка при повторной отправке outbox: {e}")
+
+    async def start_monitoring(self):
+        """Проверяет подписки по событиям источника изменений (polling, inotify или adaptive)."""
+        logger.info("🚀 Мониторинг подписок запущен...")
+        self.dispatcher.start()
+        self.profile_refresher.start()
+        try:
+            # При шардировании outbox досылается по мере получения папок (take_over)
+            # и периодически по своим папкам
+            if self.shard is not None:
+                self._replay_task = asyncio.create_task(self._replay_owned())
+            else:
+                try:
+                    await self.replay_outbox()
+                except Exception as e:
+                    logger.error(f"Ошибка при повторной отправке outbox: {e}")
+
+            async for folders in self.change_source.changes():
+                scope = "all" if folders is None else len(folders)
+                try:
+                    await self.flush_outbox_acks()
+                    with log_fields(cycle=next(self._cycles), scan_folders=scope):
+                        async with async_session() as session:
+                            await self.check_folder_updates(session, folders)
+                except Exception as e:
+                    logger.error(f"Ошибка в цикле мониторинга: {e}")
+        except asyncio.CancelledError:
+            logger.info("🛑 Мониторинг остановлен.")
 
     async def close(self):
         """Закрывает ресурсы."""
+        self.change_source.close()
+        if self._replay_task is not None:
+            self._replay_task.cancel()
+            await asyncio.gather(self._replay_task, return_exceptions=True)
+        await self.profile_refresher.close()
+        await self.digest.flush()
+        await self.dispatcher.close()
+        await self.flush_outbox_acks()
         await self.bot.session.close()
         logger.info("🔌 Сессия бота закрыта")
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from fnmatch import fnmatch
+from config import FINGERPRINT_IGNORE
+from scanner import _check_deadline, is_pruned_dir
+from utils import logger
+
+
+# last_hash: 32 hex-символа манифеста + 32 hex-символа выборки содержимого (если включена)
+PART_LEN = 32
+
+
+def is_ignored_file(name: str) -> bool:
+    """Блокировки, временные файлы и служебные файлы проводника не меняют модель."""
+    name = name.lower()
+    return any(fnmatch(name, pattern) for pattern in FINGERPRINT_IGNORE)
+
+
+def list_relevant_files(task_full_path: str, deadline: float | None = None) -> list[tuple[str, int, int]] | None:
+    """(путь относительно задания, размер, mtime_ns) всех значимых файлов в папках Data."""
+    try:
+        subfolders = [entry.path for entry in os.scandir(task_full_path) if entry.is_dir()]
+    except FileNotFoundError:
+        return None
+
+    files = []
+    stack = [os.path.join(subfolder, "Data") for subfolder in subfolders]
+    while stack:
+        _check_deadline(deadline)
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not is_pruned_dir(entry.name):
+                                stack.append(entry.path)
+                        elif not is_ignored_file(entry.name):
+                            st = entry.stat()
+                            files.append((os.path.relpath(entry.path, task_full_path), st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        pass
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.warning(f"Ошибка при сканировании {current}: {e}")
+    files.sort()
+    return files
+
+
+def sample_file(path: str, size: int, sample_bytes: int) -> bytes:
+    """Начало, середина и конец файла; для SQLite в начало попадает счётчик изменений."""
+    with open(path, 'rb') as f:
+        if size <= sample_bytes * 3:
+            return f.read()
+        chunks = [f.read(sample_bytes)]
+        for offset in ((size - sample_bytes) // 2, size - sample_bytes):
+            f.seek(offset)
+            chunks.append(f.read(sample_bytes))
+        return b"".join(chunks)
+
+
+def task_fingerprint(task_full_path: str, sample_bytes: int = 0, deadline: float | None = None) -> str | None:
+    """
+    Отпечаток папки задания: хэш манифеста (имя, размер, mtime_ns) и, если
+    sample_bytes > 0, хэш выборки содержимого тех же файлов. None — папки нет.
+    """
+    files = list_relevant_files(task_full_path, deadline)
+    if files is None:
+        return None
+
+    manifest = hashlib.sha256()
+    for rel_path, size, mtime_ns in files:
+        manifest.update(f"{rel_path}\0{size}\0{mtime_ns}\n".encode('utf-8'))
+    fingerprint = manifest.hexdigest()[:PART_LEN]
+
+    if sample_bytes > 0:
+        content = hashlib.sha256()
+        for rel_path, size, mtime_ns in files:
+            _check_deadline(deadline)
+            content.update(f"{rel_path}\0{size}\n".encode('utf-8'))
+            try:
+                content.update(sample_file(os.path.join(task_full_path, rel_path), size, sample_bytes))
+            except OSError:
+                # Файл заблокирован или удалён — считаем содержимое изменившимся
+                content.update(f"{mtime_ns}".encode('utf-8'))
+        fingerprint += content.hexdigest()[:PART_LEN]
+    return fingerprint
+
+
+def fingerprint_changed(old: str | None, new: str) -> bool:
+    """
+    Совпал манифест — изменений нет. Манифест другой, но совпала выборка
+    содержимого — файлы только «потрогали» (антивирус, резервное копирование).
+    """
+    if not old:
+        return True
+    if old[:PART_LEN] == new[:PART_LEN]:
+        return False
+    if len(old) > PART_LEN and len(new) > PART_LEN:
+        return old[PART_LEN:] != new[PART_LEN:]
+    return True
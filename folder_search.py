@@ -0,0 +1,113 @@
+import asyncio
+import os
+from utils import logger
+
+
+NGRAM = 3
+
+
+def search_key(rel_path: str) -> str:
+    return rel_path.replace(os.sep, "/").lower()
+
+
+def ngrams(text: str) -> set[str]:
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def build_index(paths) -> tuple[dict[str, str], dict[str, set[str]]]:
+    keys = {path: search_key(path) for path in paths}
+    grams: dict[str, set[str]] = {}
+    for path, key in keys.items():
+        for gram in ngrams(key):
+            grams.setdefault(gram, set()).add(path)
+    return keys, grams
+
+
+def tree_diff(old: dict, new: dict) -> tuple[set[str], set[str]]:
+    """Пути, появившиеся и исчезнувшие между двумя состояниями дерева папок."""
+    added, removed = set(), set()
+    for rel_path in old.keys() | new.keys():
+        old_entry, new_entry = old.get(rel_path), new.get(rel_path)
+        if old_entry is new_entry:
+            continue
+        old_names = set(old_entry[2]) if old_entry else set()
+        new_names = set(new_entry[2]) if new_entry else set()
+        join = (lambda name: os.path.join(rel_path, name)) if rel_path else (lambda name: name)
+        added.update(join(name) for name in new_names - old_names)
+        removed.update(join(name) for name in old_names - new_names)
+    return added, removed - added
+
+
+class FolderSearchIndex:
+    """
+    Триграммный индекс по относительным путям проектов, стадий и заданий для
+    /find. Первая сборка выполняется в потоке, дальше индекс обновляется по
+    разнице между обновлениями дерева папок. Запросы короче трёх символов
+    проверяются подстрокой по всем путям — это тоже только память.
+    """
+
+    def __init__(self):
+        self._keys: dict[str, str] = {}
+        self._grams: dict[str, set[str]] = {}
+        self._pending: list[tuple[set[str], set[str]]] | None = None
+
+    def on_tree_update(self, old: dict, new: dict):
+        added, removed = tree_diff(old, new)
+        if self._pending is not None:
+            self._pending.append((added, removed))
+        elif not self._keys and len(added) > 1000:
+            self._pending = []
+            asyncio.get_running_loop().create_task(self._build(added))
+        else:
+            self._apply(added, removed)
+
+    async def _build(self, paths: set[str]):
+        try:
+            self._keys, self._grams = await asyncio.to_thread(build_index, paths)
+            logger.info(f"🔎 Индекс поиска папок построен: {len(self._keys)} путей")
+        finally:
+            pending, self._pending = self._pending, None
+            for added, removed in pending:
+                self._apply(added, removed)
+
+    def _apply(self, added: set[str], removed: set[str]):
+        for path in removed:
+            key = self._keys.pop(path, None)
+            if key is None:
+                continue
+            for gram in ngrams(key):
+                bucket = self._grams.get(gram)
+                if bucket is not None:
+                    bucket.discard(path)
+                    if not bucket:
+                        del self._grams[gram]
+        for path in added:
+            key = search_key(path)
+            self._keys[path] = key
+            for gram in ngrams(key):
+                self._grams.setdefault(gram, set()).add(path)
+
+    def search(self, query: str, limit: int = 10) -> list[str]:
+        """Пути, содержащие query; сначала те, где совпало имя самой папки."""
+        query = search_key(query.strip())
+        if not query:
+            return []
+        if len(query) < NGRAM:
+            candidates = self._keys
+        else:
+            buckets = sorted((self._grams.get(gram, set()) for gram in ngrams(query)), key=len)
+            candidates = set.intersection(*buckets) if buckets[0] else set()
+
+        matches = [path for path in candidates if query in self._keys[path]]
+        matches.sort(key=lambda path: (
+            query not in self._keys[path].rsplit("/", 1)[-1],
+            -path.count(os.sep),
+            path,
+        ))
+        return matches[:limit]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+folder_search = FolderSearchIndex()
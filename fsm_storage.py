@@ -0,0 +1,149 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY, StateType, StorageKey
+from sqlalchemy import delete, select
+from models import FsmState, async_session, dialect_insert
+from config import FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL, FSM_STATE_TTL, FSM_MAX_DATA_BYTES
+from utils import logger
+
+
+def storage_key(key: StorageKey) -> str:
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id is not None or key.destiny != DEFAULT_DESTINY:
+        parts += [str(key.thread_id or ""), key.destiny]
+    return ":".join(parts)
+
+
+def fsm_upsert():
+    stmt = dialect_insert(FsmState)
+    return stmt.on_conflict_do_update(
+        index_elements=[FsmState.key],
+        set_={"state": stmt.excluded.state, "data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at},
+    )
+
+
+class CompactStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states с LRU-кэшем на FSM_CACHE_SIZE записей.
+    Хендлеры кладут сюда только курсор (номер страницы), данные одного
+    пользователя ограничены FSM_MAX_DATA_BYTES. Изменения копятся
+    и раз в FSM_FLUSH_INTERVAL записываются одним upsert, состояния старше
+    FSM_STATE_TTL удаляются — после перезапуска старые кнопки продолжают работать.
+    """
+
+    def __init__(self, max_entries: int = FSM_CACHE_SIZE, flush_interval: float = FSM_FLUSH_INTERVAL,
+                 ttl: float = FSM_STATE_TTL, max_data_bytes: int = FSM_MAX_DATA_BYTES):
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.max_data_bytes = max_data_bytes
+        # ключ -> (state, data в JSON, time.time() последнего изменения)
+        self._entries: OrderedDict[str, tuple[str | None, str, float]] = OrderedDict()
+        self._dirty: dict[str, tuple[str | None, str, float]] = {}
+        self._task: asyncio.Task | None = None
+
+    def _remember(self, key: str, entry: tuple[str | None, str, float]):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _load(self, key: str) -> tuple[str | None, str, float]:
+        entry = self._entries.get(key) or self._dirty.get(key)
+        if entry is None:
+            async with async_session() as session:
+                row = (await session.execute(
+                    select(FsmState.state, FsmState.data, FsmState.updated_at).where(FsmState.key == key)
+                )).first()
+            if row is not None:
+                updated_at = (row.updated_at or datetime.now()).timestamp()
+                entry = (row.state, row.data or "{}", updated_at)
+            else:
+                entry = (None, "{}", time.time())
+        if time.time() - entry[2] > self.ttl:
+            entry = (None, "{}", time.time())
+        self._remember(key, entry)
+        return entry
+
+    def _store(self, key: str, state: str | None, data: str):
+        entry = (state, data, time.time())
+        self._remember(key, entry)
+        self._dirty[key] = entry
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        key = storage_key(key)
+        state = state.state if isinstance(state, State) else state
+        current = await self._load(key)
+        if current[0] != state:
+            self._store(key, state, current[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(storage_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = storage_key(key)
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+        if len(encoded.encode("utf-8")) > self.max_data_bytes:
+            raise ValueError(f"Данные FSM для {key} больше {self.max_data_bytes} байт")
+        current = await self._load(key)
+        if current[1] != encoded:
+            self._store(key, current[0], encoded)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads((await self._load(storage_key(key)))[1])
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        rows = [
+            {"key": key, "state": state, "data": data, "updated_at": datetime.fromtimestamp(changed_at)}
+            for key, (state, data, changed_at) in dirty.items()
+        ]
+        try:
+            async with async_session() as session:
+                await session.execute(fsm_upsert(), rows)
+                await session.commit()
+        except Exception:
+            for key, entry in dirty.items():
+                self._dirty.setdefault(key, entry)
+            raise
+        logger.debug(f"🧭 Записано состояний FSM: {len(rows)}")
+
+    async def purge_expired(self):
+        expired_before = datetime.now() - timedelta(seconds=self.ttl)
+        async with async_session() as session:
+            result = await session.execute(delete(FsmState).where(FsmState.updated_at < expired_before))
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"🧭 Удалено устаревших состояний FSM: {result.rowcount}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        purged_at = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - purged_at > 3600:
+                    await self.purge_expired()
+                    purged_at = time.monotonic()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка записи состояний FSM: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
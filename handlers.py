@@ -1,20 +1,25 @@
 import os
 import asyncio
-import hashlib
 from datetime import datetime
 
 from aiogram import Router, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 
-from sqlalchemy import select, delete
-from models import User, FolderSubscription, async_session
-from config import FILES_ROOT, CHECK_INTERVAL
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import User, FolderSubscription
+from config import CHECK_INTERVAL
+from dir_tree import dir_tree
+from path_index import path_index
+from folder_search import folder_search
+from user_profiles import user_registry
 
 router = Router()
 ITEMS_PER_PAGE = 6
+FIND_RESULTS = 10
 MAX_CALLBACK_LEN = 64
 
 # ---------------- Helpers ----------------
@@ -24,8 +29,6 @@ def paginate_items(items, page):
     end = start + ITEMS_PER_PAGE
     return items[start:end], len(items)
 
-def make_callback_hash(value: str) -> str:
-    return hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
 
 async def safe_edit(message_or_callback, text, reply_markup=None):
     if isinstance(message_or_callback, Message):
@@ -61,6 +64,7 @@ async def cmd_start(message: Message):
         "Я бот для отслеживания изменений в папках на сервере выдачи заданий.\n"
         "Доступные команды:\n"
         "📁 /subscribe — подписаться на папку\n"
+        "🔎 /find текст — найти проект, стадию или задание\n"
         "📋 /my_subs — посмотреть и управлять подписками",
         reply_markup=kb
     )
@@ -75,26 +79,23 @@ async def cmd_subscribe(message: Message, state: FSMContext):
         message.from_user.first_name,
     )
 
-    projects = sorted([d for d in os.listdir(FILES_ROOT) if os.path.isdir(os.path.join(FILES_ROOT, d))])
+    projects = await dir_tree.children()
     if not projects:
         await message.answer("❌ Нет доступных проектов.")
         return
-    await state.update_data(projects=projects, page=1)
+    await state.update_data(page=1)
     await show_projects_page(message, state)
 
 async def show_projects_page(message_or_callback, state: FSMContext):
     data = await state.get_data()
     page = data.get("page", 1)
-    projects = data.get("projects", [])
+    projects = await dir_tree.children()
 
     page_items, total = paginate_items(projects, page)
     kb = InlineKeyboardBuilder()
-    hash_map = {}
 
     for proj in page_items:
-        h = make_callback_hash(proj)
-        hash_map[h] = proj
-        kb.button(text=proj, callback_data=f"proj:{h}")
+        kb.button(text=proj, callback_data=f"proj:{path_index.add(proj)}")
 
     if page > 1:
         kb.button(text="⬅️ Назад", callback_data="page_prev")
@@ -102,9 +103,31 @@ async def show_projects_page(message_or_callback, state: FSMContext):
         kb.button(text="➡️ Вперёд", callback_data="page_next")
 
     kb.adjust(2)
-    await state.update_data(hash_map_projects=hash_map, page=page)
     await safe_edit(message_or_callback, "Выберите проект:", reply_markup=kb.as_markup())
 
+# ---------------- Find ----------------
+
+@router.message(Command("find"))
+async def cmd_find(message: Message, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("🔎 Укажите часть названия: <code>/find текст</code>")
+        return
+
+    found = folder_search.search(query, FIND_RESULTS)
+    if not found:
+        await message.answer("❌ Ничего не найдено.")
+        return
+
+    # Задание подписывается одним нажатием, проект и стадия открывают навигацию
+    prefixes = {1: "proj", 2: "stage", 3: "task"}
+    kb = InlineKeyboardBuilder()
+    for rel_path in found:
+        prefix = prefixes[rel_path.count(os.sep) + 1]
+        kb.button(text=rel_path.replace(os.sep, " / "), callback_data=f"{prefix}:{path_index.add(rel_path)}")
+    kb.adjust(1)
+    await message.answer("🔎 Нажмите на задание, чтобы подписаться:", reply_markup=kb.as_markup())
+
 # ---------------- Callbacks ----------------
 
 @router.callback_query(F.data == "page_next")
@@ -123,45 +146,43 @@ async def page_prev(callback: CallbackQuery, state: FSMContext):
     await show_projects_page(callback, state)
     await callback.answer()
 
-def show_stages(project):
-    stages_path = os.path.join(FILES_ROOT, project)
-    stages = sorted([
-        d for d in os.listdir(stages_path)
-        if os.path.isdir(os.path.join(stages_path, d)) and d.lower() != "bim"
-    ])
+async def show_stages(project):
+    return await dir_tree.children(project)
 
-    return stages
+async def resolve_path(h: str, depth: int) -> list[str] | None:
+    """Части пути по хэшу из callback_data; None — неизвестный хэш или не тот уровень."""
+    rel_path = await path_index.resolve(h)
+    if rel_path is None:
+        return None
+    parts = rel_path.split(os.sep)
+    return parts if len(parts) == depth else None
 
-async def show_button_stages(stages, callback: CallbackQuery, state: FSMContext):
+async def show_button_stages(project, stages, callback: CallbackQuery):
     kb = InlineKeyboardBuilder()
-    hash_map = {}
     for st in stages:
-        h = make_callback_hash(st)
-        hash_map[h] = st
-        kb.button(text=st, callback_data=f"stage:{h}")
+        kb.button(text=st, callback_data=f"stage:{path_index.add(os.path.join(project, st))}")
     kb.button(text="⬅️ Назад", callback_data="proj_back")
     kb.adjust(2)
-    await state.update_data(hash_map_stages=hash_map)
     await callback.message.edit_text("Выберите стадию:", reply_markup=kb.as_markup())
     await callback.answer()
 
-@router.callback_query(F.data.startswith("proj:"))
-async def project_selected(callback: CallbackQuery, state: FSMContext):
-    h = callback.data.split("proj:")[1]
-    data = await state.get_data()
-    project = data["hash_map_projects"].get(h)
-    if not project:
-        await callback.answer("❌ Проект не найден.", show_alert=True)
-        return
-
-    await state.update_data(selected_project=project)
-    stages = show_stages(project)
+async def show_project_stages(project, callback: CallbackQuery):
+    stages = await show_stages(project)
     if not stages:
         await callback.message.edit_text("❌ Нет доступных стадий для проекта.")
         await callback.answer()
         return
-    
-    await show_button_stages(stages, callback, state)
+
+    await show_button_stages(project, stages, callback)
+
+@router.callback_query(F.data.startswith("proj:"))
+async def project_selected(callback: CallbackQuery):
+    parts = await resolve_path(callback.data.split("proj:")[1], 1)
+    if not parts:
+        await callback.answer("❌ Проект не найден.", show_alert=True)
+        return
+
+    await show_project_stages(parts[0], callback)
 
 
 @router.callback_query(F.data == "proj_back")
@@ -172,84 +193,63 @@ async def project_back(callback: CallbackQuery, state: FSMContext):
 # ---------------- Stage and Task Selection ----------------
 
 @router.callback_query(F.data.startswith("stage:"))
-async def stage_selected(callback: CallbackQuery, state: FSMContext):
-    h = callback.data.split("stage:")[1]
-    data = await state.get_data()
-    stage = data["hash_map_stages"].get(h)
-    if not stage:
+async def stage_selected(callback: CallbackQuery):
+    parts = await resolve_path(callback.data.split("stage:")[1], 2)
+    if not parts:
         await callback.answer("❌ Стадия не найдена.", show_alert=True)
         return
 
-    await state.update_data(selected_stage=stage)
-    tasks_path = os.path.join(FILES_ROOT, data["selected_project"], stage)
-    tasks = sorted([d for d in os.listdir(tasks_path) if os.path.isdir(os.path.join(tasks_path, d))])
+    project, stage = parts
+    tasks = await dir_tree.children(project, stage)
     if not tasks:
         await callback.message.edit_text("❌ Нет доступных заданий для стадии.")
         await callback.answer()
         return
 
     kb = InlineKeyboardBuilder()
-    hash_map = {}
     for t in tasks:
-        h = make_callback_hash(t)
-        hash_map[h] = t
-        kb.button(text=t, callback_data=f"task:{h}")
+        kb.button(text=t, callback_data=f"task:{path_index.add(os.path.join(project, stage, t))}")
     kb.adjust(2)
-    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="stage_back"))
-    await state.update_data(hash_map_tasks=hash_map)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"stage_back:{path_index.add(project)}"))
     await callback.message.edit_text("Выберите задание:", reply_markup=kb.as_markup())
     await callback.answer()
 
-@router.callback_query(F.data == "stage_back")
-async def stage_back(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    project = data.get("selected_project")
-    
-    if not project:
+@router.callback_query(F.data.startswith("stage_back"))
+async def stage_back(callback: CallbackQuery):
+    # Кнопки, отрисованные до перехода на индекс путей, приходят без хэша
+    h = callback.data.partition(":")[2]
+    parts = await resolve_path(h, 1) if h else None
+    if not parts:
         await callback.answer("❌ Проект не найден.", show_alert=True)
         return
-    
-    stages = show_stages(project)
-    if not stages:
-        await callback.message.edit_text("❌ Нет доступных стадий для проекта.")
-        await callback.answer()
-        return
 
-    await show_button_stages(stages, callback, state)
+    await show_project_stages(parts[0], callback)
 
 @router.callback_query(F.data.startswith("task:"))
-async def task_selected(callback: CallbackQuery, state: FSMContext):
-    h = callback.data.split("task:")[1]
-    data = await state.get_data()
-    task = data["hash_map_tasks"].get(h)
-    if not task:
+async def task_selected(callback: CallbackQuery, session: AsyncSession):
+    parts = await resolve_path(callback.data.split("task:")[1], 3)
+    if not parts:
         await callback.answer("❌ Задание не найдено.", show_alert=True)
         return
 
-    project, stage = data["selected_project"], data["selected_stage"]
-    folder_path = os.path.join(project, stage, task)
-
-    async with async_session() as session:
-        user_result = await session.execute(select(User).where(User.tg_id == callback.from_user.id))
-        user = user_result.scalar_one_or_none()
-        if not user:
-            user = User(tg_id=callback.from_user.id, username = callback.from_user.username, first_name = callback.from_user.first_name )
-            session.add(user)
-            await session.commit()
-        else:
-            user.username = callback.from_user.username or ''
-            user.first_name = callback.from_user.first_name
-            await session.commit()
-
-        sub_result = await session.execute(
-            select(FolderSubscription).where(FolderSubscription.user_id == user.id,
-                                            FolderSubscription.folder_path == folder_path)
-        )
-        subscription = sub_result.scalar_one_or_none()
-        if not subscription:
-            subscription = FolderSubscription(user_id=user.id, folder_path=folder_path)
-            session.add(subscription)
-            await session.commit()
+    folder_path = os.path.join(*parts)
+
+    user_id = await user_registry.ensure(
+        callback.from_user.id,
+        callback.from_user.username,
+        callback.from_user.first_name,
+        session=session,
+    )
+
+    sub_result = await session.execute(
+        select(FolderSubscription).where(FolderSubscription.user_id == user_id,
+                                        FolderSubscription.folder_path == folder_path)
+    )
+    subscription = sub_result.scalar_one_or_none()
+    if not subscription:
+        subscription = FolderSubscription(user_id=user_id, folder_path=folder_path)
+        session.add(subscription)
+        await session.flush()
 
     await callback.message.edit_text(
         f"✅ Теперь вы будете получать уведомления о любых изменениях в папке:\n<code>{folder_path}</code>",
@@ -260,41 +260,42 @@ async def task_selected(callback: CallbackQuery, state: FSMContext):
 # ---------------- My Subs ----------------
 
 @router.message(Command("my_subs"))
-async def cmd_my_subs(message: Message, state: FSMContext):
+async def cmd_my_subs(message: Message, state: FSMContext, session: AsyncSession):
     await update_user_data(
         message.from_user.id,
         message.from_user.username,
         message.from_user.first_name
     )
-    async with async_session() as session:
-        user_result = await session.execute(select(User).where(User.tg_id == message.from_user.id))
-        user = user_result.scalar_one_or_none()
-        if not user:
-            await message.answer("❌ У вас нет подписок.")
-            return
-        result = await session.execute(select(FolderSubscription).where(FolderSubscription.user_id == user.id))
-        subs = [s.folder_path for s in result.scalars().all()]
-
-    if not subs:
+    await state.update_data(page=1)
+    if not await show_subs_page(message, state, session, message.from_user.id):
         await message.answer("❌ У вас нет подписок.")
-        return
 
-    await state.update_data(subs=subs, page=1)
-    await show_subs_page(message, state)
+async def load_subs_page(session: AsyncSession, tg_id: int, page: int) -> tuple[list[str], int, int]:
+    """Одна страница подписок пользователя (LIMIT/OFFSET), их общее число и номер страницы в пределах."""
+    user_subs = (
+        select(FolderSubscription.folder_path)
+        .join(User, User.id == FolderSubscription.user_id)
+        .where(User.tg_id == tg_id)
+    )
+    total = await session.scalar(select(func.count()).select_from(user_subs.subquery()))
+    pages = max(1, (total + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE)
+    page = min(max(1, page), pages)
+    result = await session.execute(
+        user_subs.order_by(FolderSubscription.id)
+        .limit(ITEMS_PER_PAGE).offset((page - 1) * ITEMS_PER_PAGE)
+    )
+    return list(result.scalars()), total, page
 
-async def show_subs_page(message_or_callback, state: FSMContext):
+async def show_subs_page(message_or_callback, state: FSMContext, session: AsyncSession, tg_id: int) -> bool:
+    """Показывает текущую страницу подписок; False — подписок нет."""
     data = await state.get_data()
-    page = data["page"]
-    subs = data["subs"]
-
-    page_items, total = paginate_items(subs, page)
+    page_items, total, page = await load_subs_page(session, tg_id, data.get("page", 1))
+    if not total:
+        return False
     kb = InlineKeyboardBuilder()
-    hash_map = {}
 
     for s in page_items:
-        h = make_callback_hash(s)
-        hash_map[h] = s
-        kb.button(text=f"❌ {s}", callback_data=f"delete_sub:{h}")
+        kb.button(text=f"❌ {s}", callback_data=f"delete_sub:{path_index.add(s)}")
 
     if page > 1:
         kb.button(text="⬅️ Назад", callback_data="subs_page_prev")
@@ -302,13 +303,14 @@ async def show_subs_page(message_or_callback, state: FSMContext):
         kb.button(text="➡️ Вперёд", callback_data="subs_page_next")
 
     kb.adjust(1)
-    await state.update_data(hash_map_subs=hash_map, page=page)
+    await state.update_data(page=page)
     await safe_edit(message_or_callback, "Ваши подписки (нажмите для удаления):", reply_markup=kb.as_markup())
+    return True
 
 # ---------------- Sub Pagination ----------------
 
 @router.callback_query(F.data.startswith("subs_page_"))
-async def subs_paginate_callback(callback: CallbackQuery, state: FSMContext):
+async def subs_paginate_callback(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     page = data.get("page", 1)
     if callback.data == "subs_page_prev":
@@ -317,41 +319,28 @@ async def subs_paginate_callback(callback: CallbackQuery, state: FSMContext):
         page += 1
     await state.update_data(page=page)
     await callback.answer()
-    await show_subs_page(callback, state)
+    if not await show_subs_page(callback, state, session, callback.from_user.id):
+        await safe_edit(callback, "❌ У вас нет подписок.")
 
 @router.callback_query(F.data.startswith("delete_sub:"))
-async def delete_subscription(callback: CallbackQuery, state: FSMContext):
-    h = callback.data.split("delete_sub:")[1]
-    data = await state.get_data()
-    folder_path = data.get("hash_map_subs", {}).get(h)
+async def delete_subscription(callback: CallbackQuery, state: FSMContext, session: AsyncSession):
+    folder_path = await path_index.resolve(callback.data.split("delete_sub:")[1])
     if not folder_path:
         await callback.answer("❌ Подписка не найдена.", show_alert=True)
         return
 
-    async with async_session() as session:
-        user_result = await session.execute(select(User).where(User.tg_id == callback.from_user.id))
-        user = user_result.scalar_one()
-        await session.execute(delete(FolderSubscription).where(
-            FolderSubscription.user_id == user.id,
-            FolderSubscription.folder_path == folder_path
-        ))
-        await session.commit()
-
-    subs = [s for s in data.get("subs", []) if s != folder_path]
-    await state.update_data(subs=subs)
+    user_ids = select(User.id).where(User.tg_id == callback.from_user.id).scalar_subquery()
+    result = await session.execute(delete(FolderSubscription).where(
+        FolderSubscription.user_id == user_ids,
+        FolderSubscription.folder_path == folder_path
+    ))
+    if not result.rowcount:
+        await callback.answer("❌ Подписка не найдена.", show_alert=True)
+        return
+
     await callback.answer(f"❌ Подписка удалена: {folder_path}")
-    await show_subs_page(callback, state)
+    if not await show_subs_page(callback, state, session, callback.from_user.id):
+        await safe_edit(callback, "❌ У вас нет подписок.")
 
 async def update_user_data(user_id: int, username: str, first_name: str):
-    async with async_session() as session:
-        user_result = await session.execute(select(User).where(User.tg_id == user_id))
-        user = user_result.scalar_one_or_none()
-        
-        if not user:
-            user = User(tg_id=user_id, username=username, first_name=first_name)
-            session.add(user)
-        else:
-            user.username = username
-            user.first_name = first_name
-        
-        await session.commit()
\ No newline at end of file
+    user_registry.touch(user_id, username, first_name)
@@ -1,22 +1,47 @@
 import asyncio
 import logging
 import os
+from contextlib import suppress
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from config import BOT_TOKEN, FILES_ROOT
+from config import BOT_TOKEN, FILES_ROOT, INSTANCE_ROLE, SHARDING_ENABLED
 from models import init_db
 from handlers import router
 from admin_handlers import admin_router
 from middleware import DatabaseMiddleware
+from fsm_storage import CompactStorage
+from metrics import MetricsMiddleware, metrics_server
 from file_watcher import FileWatcher
-from utils import logger
+from scanner import scan_executor
+from dir_tree import dir_tree
+from path_index import path_index
+from folder_search import folder_search
+from user_profiles import user_registry
+from sharding import LeaderLease, shard_coordinator
+from utils import bot_session, logger
+
+async def stop_polling(dp: Dispatcher | None, polling_task: asyncio.Task | None, polling_lease: LeaderLease | None):
+    if polling_lease is not None:
+        # run() сам останавливает опрос и освобождает аренду
+        polling_task.cancel()
+        await asyncio.gather(polling_task, return_exceptions=True)
+    elif dp is not None and polling_task is not None and not polling_task.done():
+        # Повторный вызов (Ctrl+C, затем finally) после остановки бросает RuntimeError
+        with suppress(RuntimeError):
+            await dp.stop_polling()
+
 
 async def main():
     watcher_task = None
     file_watcher = None
     bot = None
     dp = None
+    storage = None
+    polling_task = None
+    polling_lease = None
+    run_bot = INSTANCE_ROLE in ("all", "bot")
+    run_watcher = INSTANCE_ROLE in ("all", "watcher")
 
     stop_event = asyncio.Event()
 
@@ -24,22 +49,48 @@ async def main():
         os.makedirs(FILES_ROOT, exist_ok=True)
         logger.info(f"📂 Рабочая директория: {FILES_ROOT}")
 
-        await init_db()
-
-        bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-        dp = Dispatcher()
-
-        dp.update.middleware(DatabaseMiddleware())
-        dp.include_router(router)
-        dp.include_router(admin_router)
-
-        file_watcher = FileWatcher(BOT_TOKEN)
-        watcher_task = asyncio.create_task(file_watcher.start_monitoring())
-
-        logger.info("🤖 Бот запущен")
-        logger.info("🔍 Мониторинг файлов активен")
+        if not (run_bot or run_watcher):
+            raise ValueError(f"Неизвестная роль INSTANCE_ROLE={INSTANCE_ROLE!r} (all | bot | watcher)")
 
-        polling_task = asyncio.create_task(dp.start_polling(bot))
+        await init_db()
+        logger.info(f"🧭 Роль экземпляра: {INSTANCE_ROLE}" + (", шардирование включено" if SHARDING_ENABLED else ""))
+        await metrics_server.start()
+
+        if run_bot:
+            await path_index.load_subscriptions()
+
+            bot = Bot(token=BOT_TOKEN, session=bot_session(), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+            storage = CompactStorage()
+            dp = Dispatcher(storage=storage)
+
+            dp.update.middleware(DatabaseMiddleware())
+            dp.include_router(router)
+            dp.include_router(admin_router)
+            for r in (router, admin_router):
+                r.message.middleware(MetricsMiddleware())
+                r.callback_query.middleware(MetricsMiddleware())
+
+            storage.start()
+            dir_tree.add_listener(path_index.on_tree_update)
+            dir_tree.add_listener(folder_search.on_tree_update)
+            dir_tree.start()
+            user_registry.start()
+
+        if run_watcher:
+            if SHARDING_ENABLED:
+                shard_coordinator.start()
+            file_watcher = FileWatcher(BOT_TOKEN, shard=shard_coordinator if SHARDING_ENABLED else None)
+            watcher_task = asyncio.create_task(file_watcher.start_monitoring())
+            logger.info("🔍 Мониторинг файлов активен")
+
+        if run_bot:
+            logger.info("🤖 Бот запущен")
+            if SHARDING_ENABLED:
+                # Telegram отдаёт апдейты одному getUpdates — опрашивает только держатель аренды
+                polling_lease = LeaderLease("telegram_polling")
+                polling_task = asyncio.create_task(polling_lease.run(lambda: dp.start_polling(bot), dp.stop_polling))
+            else:
+                polling_task = asyncio.create_task(dp.start_polling(bot))
 
         # Instead of signal handlers, wait on event; KeyboardInterrupt handled below
         await stop_event.wait()
@@ -48,8 +99,7 @@ async def main():
         logger.info("🛑 Получен сигнал остановки (Ctrl+C)")
         stop_event.set()
 
-        if dp is not None and bot is not None:
-            await dp.stop_polling()
+        await stop_polling(dp, polling_task, polling_lease)
 
         if watcher_task is not None:
             watcher_task.cancel()
@@ -64,8 +114,7 @@ async def main():
     finally:
         logger.info("🛑 Начинается корректное завершение работы...")
 
-        if dp is not None and bot is not None:
-            await dp.stop_polling()
+        await stop_polling(dp, polling_task, polling_lease)
 
         if watcher_task is not None:
             watcher_task.cancel()
@@ -77,6 +126,16 @@ async def main():
         if file_watcher is not None:
             await file_watcher.close()
 
+        if storage is not None:
+            await storage.close()
+
+        await shard_coordinator.close()
+
+        await dir_tree.close()
+        await user_registry.close()
+        await metrics_server.close()
+        scan_executor.shutdown()
+
         if bot is not None:
             await bot.session.close()
             logger.info("🔌 Сессия бота закрыта")
@@ -0,0 +1,276 @@
+import bisect
+import time
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from config import METRICS_HOST, METRICS_PORT
+from utils import logger
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_str(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_label_str(names, values)} {value:g}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield "_total", self.labels, key, value
+
+
+class Gauge(Metric):
+    """Значение задаётся set() или вычисляется функцией при каждом чтении."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, func: Callable[[], float], **labels):
+        self._functions[self._key(labels)] = func
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        if key in self._functions:
+            return self._functions[key]()
+        return self.values.get(key, 0)
+
+    def samples(self):
+        for key, value in self.values.items():
+            if key not in self._functions:
+                yield "", self.labels, key, value
+        for key, func in self._functions.items():
+            try:
+                yield "", self.labels, key, func()
+            except Exception:
+                pass
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # ключ меток -> [счётчики по корзинам (+Inf последней), сумма, количество]
+        self.values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def quantile(self, q: float, **labels) -> float | None:
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        entry = self.values.get(self._key(labels))
+        if entry is None or not entry[2]:
+            return None
+        rank = q * entry[2]
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), entry[0]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self, **labels) -> tuple[int, float]:
+        entry = self.values.get(self._key(labels))
+        return (entry[2], entry[1]) if entry else (0, 0.0)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            names = self.labels + ("le",)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield "_bucket", names, key + (le,), cumulative
+            yield "_sum", self.labels, key, total
+            yield "_count", self.labels, key, count
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Сканирование
+scan_cycle_seconds = registry.register(Histogram(
+    "watcher_scan_cycle_seconds", "Длительность цикла check_folder_updates"))
+task_scan_seconds = registry.register(Histogram(
+    "watcher_task_scan_seconds", "Длительность сканирования одной папки задания"))
+scan_dirs_total = registry.register(Counter(
+    "watcher_scan_dirs", "Прочитано папок (scandir) при сканировании"))
+scan_stat_calls_total = registry.register(Counter(
+    "watcher_scan_stat_calls", "Вызовов stat при сканировании"))
+scan_errors_total = registry.register(Counter(
+    "watcher_scan_errors", "Ошибки и таймауты сканирования", ("kind",)))
+subscribed_folders = registry.register(Gauge(
+    "watcher_subscribed_folders", "Папок заданий с подписками"))
+
+# Model.db3
+model_db_read_seconds = registry.register(Histogram(
+    "watcher_model_db_read_seconds", "Время чтения ModelHistory из Model.db3"))
+model_db_cache_total = registry.register(Counter(
+    "watcher_model_db_cache", "Обращения к кэшу ModelHistory", ("result",)))
+
+# Уведомления
+notify_queue_depth = registry.register(Gauge(
+    "notify_queue_depth", "Сообщений в очереди отправки"))
+notify_send_seconds = registry.register(Histogram(
+    "notify_send_seconds", "Длительность вызова send_message"))
+notify_lag_seconds = registry.register(Histogram(
+    "notify_lag_seconds", "Задержка от постановки в очередь до доставки"))
+notify_sent_total = registry.register(Counter(
+    "notify_sent", "Доставлено уведомлений"))
+notify_errors_total = registry.register(Counter(
+    "notify_errors", "Ошибки отправки уведомлений", ("kind",)))
+
+# Хендлеры
+handler_seconds = registry.register(Histogram(
+    "bot_handler_seconds", "Длительность обработки апдейта хендлером", ("handler",)))
+handler_errors_total = registry.register(Counter(
+    "bot_handler_errors", "Исключения в хендлерах", ("handler",)))
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware роутера: к этому моменту фильтры пройдены и известен
+    хендлер, поэтому метка — имя функции, а не произвольный текст сообщения.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors_total.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+
+class MetricsServer:
+    """Локальный HTTP-эндпоинт /metrics в текстовом формате Prometheus (METRICS_PORT=0 — выключен)."""
+
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        if not self.port or self._runner is not None:
+            return
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except OSError as e:
+            logger.error(f"Не удалось открыть порт метрик {self.host}:{self.port}: {e}")
+            await self.close()
+            return
+        logger.info(f"📈 Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer()
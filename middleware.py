@@ -3,18 +3,51 @@ from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 from models import async_session
 
+
+class LazySession:
+    """
+    Обёртка над AsyncSession, которая создаёт сессию при первом обращении.
+    Апдейты, не трогающие БД (пагинация, навигация), не открывают сессию
+    и не берут соединение из пула.
+    """
+
+    def __init__(self, factory=async_session):
+        self._factory = factory
+        self._session = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._factory()
+        return getattr(self._session, name)
+
+
 class DatabaseMiddleware(BaseMiddleware):
+    """
+    Одна ленивая сессия на апдейт (data["session"]): все хендлеры и хелперы
+    работают в одной единице работы, commit/rollback выполняются здесь.
+    """
+
     async def __call__(
         self,
         handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
         event: TelegramObject,
         data: Dict[str, Any]
     ) -> Any:
-        async with async_session() as session:
-            data["session"] = session
-            try:
-                result = await handler(event, data)
-                return result
-            except Exception as e:
+        session = LazySession()
+        data["session"] = session
+        try:
+            result = await handler(event, data)
+            if session.opened and session.in_transaction():
+                await session.commit()
+            return result
+        except Exception as e:
+            if session.opened:
                 await session.rollback()
-                raise e
\ No newline at end of file
+            raise e
+        finally:
+            if session.opened:
+                await session.close()
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from urllib.request import pathname2url
+import aiosqlite
+from config import MODEL_HISTORY_CACHE_SIZE, MODEL_DB_IMMUTABLE
+from metrics import model_db_read_seconds, model_db_cache_total
+from utils import logger
+
+
+LAST_VERSION_QUERY = "SELECT VersionNumber, Comment, UserName FROM ModelHistory ORDER BY VersionNumber DESC LIMIT 1"
+
+
+class ModelHistoryCache:
+    """
+    LRU-кэш последней записи ModelHistory из Model.db3. Запись действительна,
+    пока у файла и его журнала -wal не изменились размер и mtime (коммит в
+    WAL-режиме основной файл не трогает), поэтому на одно реальное изменение
+    модели приходится один запрос, сколько бы подписчиков ни уведомлялось.
+    Параллельные запросы одного и того же файла ждут общий результат.
+    """
+
+    def __init__(self, max_entries: int = MODEL_HISTORY_CACHE_SIZE, immutable: bool = MODEL_DB_IMMUTABLE):
+        self.max_entries = max_entries
+        self.immutable = immutable
+        self._entries: OrderedDict[str, tuple[tuple, tuple]] = OrderedDict()
+        self._inflight: dict[tuple[str, tuple], asyncio.Future] = {}
+
+    @staticmethod
+    def _signature(db_path: str) -> tuple:
+        """
+        (размер, mtime) Model.db3 и Model.db3-wal (None, None — журнала нет) и
+        наличие -shm. Выполняется в потоке.
+        """
+        st = os.stat(db_path)
+        try:
+            wal = os.stat(db_path + "-wal")
+            wal_sig = (wal.st_size, wal.st_mtime_ns)
+        except OSError:
+            wal_sig = (None, None)
+        return (st.st_size, st.st_mtime_ns) + wal_sig + (os.path.exists(db_path + "-shm"),)
+
+    def _uri(self, db_path: str, signature: tuple) -> str:
+        # mode=ro — не берём блокировку на запись. immutable=1 игнорирует -wal,
+        # поэтому при журнале рядом читаем обычным образом, иначе получим старую версию
+        uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+        has_sidecar = signature[2] is not None or signature[4]
+        if self.immutable and not has_sidecar:
+            uri += "&immutable=1"
+        return uri
+
+    async def _read(self, db_path: str, signature: tuple) -> tuple | None:
+        started = time.perf_counter()
+        try:
+            async with aiosqlite.connect(self._uri(db_path, signature), uri=True) as conn:
+                async with conn.execute(LAST_VERSION_QUERY) as cursor:
+                    row = await cursor.fetchone()
+                    return tuple(row) if row else None
+        except aiosqlite.Error as e:
+            logger.error(f"SQLite error: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error in get_comment: {e}")
+        finally:
+            model_db_read_seconds.observe(time.perf_counter() - started)
+        return None
+
+    async def get(self, db_path: str) -> tuple | None:
+        """Возвращает (VersionNumber, Comment, UserName) или None."""
+        try:
+            signature = await asyncio.to_thread(self._signature, db_path)
+        except OSError as e:
+            logger.error(f"Model.db3 недоступен {db_path}: {e}")
+            return None
+
+        cached = self._entries.get(db_path)
+        if cached is not None and cached[0] == signature:
+            self._entries.move_to_end(db_path)
+            model_db_cache_total.inc(result="hit")
+            return cached[1]
+
+        key = (db_path, signature)
+        future = self._inflight.get(key)
+        if future is not None:
+            model_db_cache_total.inc(result="shared")
+            return await asyncio.shield(future)
+        model_db_cache_total.inc(result="miss")
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            row = await self._read(db_path, signature)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        # Ошибки чтения не кэшируются — файл мог быть недописан
+        if row is not None:
+            self._entries[db_path] = (signature, row)
+            self._entries.move_to_end(db_path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(row)
+        return row
+
+
+model_history = ModelHistoryCache()
@@ -1,12 +1,55 @@
-from sqlalchemy import Integer, BigInteger, String, Text, DateTime, ForeignKey, UniqueConstraint, select
+from sqlalchemy import Integer, BigInteger, String, Text, DateTime, ForeignKey, UniqueConstraint, event, select
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
-from config import DATABASE_URL
+from config import (
+    DATABASE_URL,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT, SQLITE_MMAP_SIZE,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE,
+)
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+
+def build_engine(url: str = DATABASE_URL):
+    """
+    Движок с профилем под бэкенд. SQLite: WAL (читатели не ждут писателя),
+    synchronous=NORMAL, busy_timeout вместо мгновенного "database is locked"
+    и mmap. PostgreSQL: пул соединений с настраиваемым размером.
+    """
+    if url.startswith("sqlite"):
+        engine = create_async_engine(url, echo=False, connect_args={"timeout": SQLITE_BUSY_TIMEOUT / 1000})
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+            cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            cursor.close()
+
+        return engine
+
+    return create_async_engine(
+        url,
+        echo=False,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+engine = build_engine()
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
+
+def dialect_insert(model):
+    """INSERT диалекта движка — для ON CONFLICT (upsert) и в SQLite, и в PostgreSQL."""
+    insert = postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(model)
+
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
@@ -26,12 +69,14 @@ class User(Base):
 
 class FolderSubscription(Base):
     __tablename__ = "folder_subscriptions"
+    # Поиск по user_id обслуживает уникальный индекс (user_id, folder_path) — отдельный
+    # индекс по user_id не нужен; по folder_path группирует и ищет watcher.
     __table_args__ = (
         UniqueConstraint('user_id', 'folder_path', name='_user_folder_uc'),
     )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.tg_id"), index=True)
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"))
     folder_path: Mapped[str] = mapped_column(Text, index=True)
     last_hash: Mapped[str] = mapped_column(String(64), nullable=True)
     last_modified: Mapped[datetime] = mapped_column(DateTime, nullable=True)
@@ -40,6 +85,53 @@ class FolderSubscription(Base):
     user: Mapped["User"] = relationship("User", back_populates="subscriptions")
 
 
+class NotificationOutbox(Base):
+    """
+    Уведомления, зафиксированные в одной транзакции с last_modified. Строка
+    удаляется после доставки; всё, что осталось после падения, отправляется
+    при следующем запуске.
+    """
+    __tablename__ = "notification_outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer)
+    folder_path: Mapped[str] = mapped_column(Text)
+    data_path: Mapped[str] = mapped_column(Text)
+    db_path: Mapped[str] = mapped_column(Text, nullable=True)
+    changed_at: Mapped[datetime] = mapped_column(DateTime)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class FsmState(Base):
+    """Состояние FSM пользователя: только курсор навигации (номер страницы)."""
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(128), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[str] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class WatcherWorker(Base):
+    """Живой воркер наблюдения; heartbeat_at старше SHARD_LEASE_TTL — воркер упал."""
+    __tablename__ = "watcher_workers"
+
+    worker_id: Mapped[str] = mapped_column(String(128), primary_key=True)
+    host: Mapped[str] = mapped_column(String(255), nullable=True)
+    pid: Mapped[int] = mapped_column(Integer, nullable=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    heartbeat_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+
+class Lease(Base):
+    """Именованная эксклюзивная аренда: например, опрос Telegram одним экземпляром."""
+    __tablename__ = "leases"
+
+    name: Mapped[str] = mapped_column(String(64), primary_key=True)
+    holder: Mapped[str] = mapped_column(String(128))
+    expires_at: Mapped[datetime] = mapped_column(DateTime)
+
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
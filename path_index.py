@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import os
+from sqlalchemy import select
+from models import FolderSubscription, async_session
+from utils import logger
+
+
+def path_hash(rel_path: str) -> str:
+    """16 байт sha256 от полного относительного пути (32 hex-символа для callback_data)."""
+    return hashlib.sha256(rel_path.encode('utf-8')).hexdigest()[:32]
+
+
+class PathHashIndex:
+    """
+    Общий для процесса индекс хэш → относительный путь. Наполняется из дерева
+    папок и из таблицы подписок, поэтому callback_data кнопок разрешается
+    одним поиском в словаре без FSM, и старые клавиатуры работают после
+    перезапуска. Записи только добавляются: хэш исчезнувшей папки остаётся
+    валидным, а сама папка проверяется уже при действии.
+    """
+
+    def __init__(self):
+        self._paths: dict[str, str] = {}
+        self._ready = asyncio.Event()
+
+    def add(self, rel_path: str) -> str:
+        h = path_hash(rel_path)
+        self._paths[h] = rel_path
+        return h
+
+    def on_tree_update(self, old: dict, new: dict):
+        # Перехэшируются только узлы, чей список подпапок изменился
+        for rel_path, entry in new.items():
+            if old.get(rel_path) is entry:
+                continue
+            for name in entry[2]:
+                self.add(os.path.join(rel_path, name) if rel_path else name)
+        self._ready.set()
+
+    async def load_subscriptions(self):
+        async with async_session() as session:
+            result = await session.execute(select(FolderSubscription.folder_path).distinct())
+            for folder_path in result.scalars():
+                self.add(folder_path)
+        logger.info(f"🔑 Индекс путей: {len(self._paths)} записей")
+
+    async def resolve(self, h: str, timeout: float = 10) -> str | None:
+        rel_path = self._paths.get(h)
+        if rel_path is None and not self._ready.is_set():
+            # Первый обход дерева после запуска ещё не завершён
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            rel_path = self._paths.get(h)
+        return rel_path
+
+    def __len__(self):
+        return len(self._paths)
+
+
+path_index = PathHashIndex()
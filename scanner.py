@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import NamedTuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from config import (
+    SCAN_EXECUTOR, SCAN_WORKERS, SCAN_TIMEOUT,
+    MTIME_INDEX_DIR, MTIME_INDEX_FULL_SCAN_INTERVAL, SCAN_PRUNE_DIRS,
+)
+from utils import child_log_queue, log_to_queue, logger
+
+
+DB_FILE_NAME = 'Model.db3'
+
+
+class ScanTimeout(Exception):
+    """Сканирование не уложилось в отведённое время."""
+
+
+class WalkResult(NamedTuple):
+    latest_mtime: float
+    db_path: str | None
+
+
+class TaskScan(NamedTuple):
+    latest_mtime: float
+    data_folder: str | None
+    db_path: str | None
+    # Для метрик: прочитано папок, вызовов stat, длительность в секундах
+    dirs: int = 0
+    stat_calls: int = 0
+    duration: float = 0.0
+
+
+def new_scan_stats() -> dict:
+    return {"dirs": 0, "stat_calls": 0}
+
+
+def _check_deadline(deadline: float | None):
+    # time.monotonic общий для всех процессов хоста, поэтому дедлайн можно
+    # передавать и в пул потоков, и в пул процессов
+    if deadline is not None and time.monotonic() > deadline:
+        raise ScanTimeout()
+
+
+def is_pruned_dir(name: str) -> bool:
+    """Папки резервных копий и временные папки Revit не влияют на уведомления."""
+    name = name.lower()
+    return name in SCAN_PRUNE_DIRS or name.endswith('_backup')
+
+
+def walk_data_folder(folder_path: str, deadline: float | None = None, stats: dict | None = None) -> WalkResult:
+    """
+    Один проход по дереву на os.scandir: возвращает самое свежее время изменения
+    (папок и файлов) и путь к самому верхнему Model.db3. Время берётся из
+    DirEntry.stat(), поэтому на файл уходит не больше одного системного вызова
+    (на Windows/SMB — ни одного сверх листинга). Если папки нет — (0.0, None).
+    В stats накапливаются счётчики для метрик.
+    """
+    stats = new_scan_stats() if stats is None else stats
+    stats["stat_calls"] += 1
+    try:
+        latest = os.stat(folder_path).st_mtime
+    except OSError:
+        return WalkResult(0.0, None)
+
+    db_path = None
+    stack = [folder_path]
+    while stack:
+        _check_deadline(deadline)
+        current = stack.pop()
+        stats["dirs"] += 1
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if is_pruned_dir(entry.name):
+                                continue
+                            stack.append(entry.path)
+                        elif entry.name == DB_FILE_NAME:
+                            # Приоритет у файла, лежащего ближе к корню Data
+                            if db_path is None or entry.path.count(os.sep) < db_path.count(os.sep):
+                                db_path = entry.path
+                        stats["stat_calls"] += 1
+                        mtime = entry.stat().st_mtime
+                        if mtime > latest:
+                            latest = mtime
+                    except OSError:
+                        pass
+        except OSError as e:
+            logger.warning(f"Ошибка при сканировании {current}: {e}")
+    return WalkResult(latest, db_path)
+
+
+def get_folder_mtime_recursive(folder_path: str, deadline: float | None = None) -> float:
+    """
+    Рекурсивно возвращает самое свежее время изменения в папке.
+    Если папки нет — возвращает 0.0.
+    """
+    return walk_data_folder(folder_path, deadline).latest_mtime
+
+
+def _index_file(task_full_path: str) -> str:
+    key = hashlib.sha1(os.path.abspath(task_full_path).encode('utf-8')).hexdigest()
+    return os.path.join(MTIME_INDEX_DIR, f"{key}.json")
+
+
+def load_mtime_index(task_full_path: str) -> dict:
+    """Загружает индекс mtime папки задания; при отсутствии или порче — пустой индекс."""
+    try:
+        with open(_index_file(task_full_path), encoding='utf-8') as f:
+            index = json.load(f)
+        if isinstance(index.get("dirs"), dict):
+            return index
+    except (OSError, ValueError):
+        pass
+    return {"full_scan_at": 0.0, "dirs": {}}
+
+
+def remove_mtime_index(task_full_path: str):
+    """Удаляет индекс mtime папки задания, которой больше нет."""
+    try:
+        os.remove(_index_file(task_full_path))
+    except OSError:
+        pass
+
+
+def save_mtime_index(task_full_path: str, index: dict):
+    path = _index_file(task_full_path)
+    os.makedirs(MTIME_INDEX_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def get_folder_mtime_incremental(folder_path: str, old_dirs: dict, new_dirs: dict,
+                                 deadline: float | None = None, stats: dict | None = None) -> WalkResult:
+    """
+    Как walk_data_folder, но перечитывает содержимое только тех папок, чьё
+    собственное mtime изменилось с прошлого прохода. Для остальных берётся
+    сохранённое время самого свежего файла, так что на неизменное дерево уходит
+    по одному stat на папку.
+
+    Запись в old_dirs: [mtime_ns папки, самый свежий mtime файла, подпапки, файлы .db3].
+    Файлы .db3 перечитываются всегда: SQLite меняет их на месте, не трогая папку.
+    Запись на месте в другие файлы mtime папки не меняет — такое изменение будет
+    замечено при полном проходе (MTIME_INDEX_FULL_SCAN_INTERVAL).
+    """
+    _check_deadline(deadline)
+    stats = new_scan_stats() if stats is None else stats
+    stats["stat_calls"] += 1
+    try:
+        st = os.stat(folder_path)
+    except OSError:
+        return WalkResult(0.0, None)
+
+    entry = old_dirs.get(folder_path)
+    if entry is not None and len(entry) == 4 and entry[0] == st.st_mtime_ns:
+        _, newest_file, subdirs, db_files = entry
+        latest_file = newest_file
+        stats["stat_calls"] += len(db_files)
+        for name in db_files:
+            try:
+                latest_file = max(latest_file, os.stat(os.path.join(folder_path, name)).st_mtime)
+            except OSError:
+                pass
+    else:
+        newest_file = 0.0
+        subdirs = []
+        db_files = []
+        stats["dirs"] += 1
+        try:
+            with os.scandir(folder_path) as it:
+                for dir_entry in it:
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            if not is_pruned_dir(dir_entry.name):
+                                subdirs.append(dir_entry.name)
+                            continue
+                        if dir_entry.name.endswith('.db3'):
+                            db_files.append(dir_entry.name)
+                        stats["stat_calls"] += 1
+                        newest_file = max(newest_file, dir_entry.stat().st_mtime)
+                    except OSError:
+                        pass
+        except OSError as e:
+            logger.warning(f"Ошибка при сканировании {folder_path}: {e}")
+        latest_file = newest_file
+
+    # В индекс — время из scandir: перезапись .db3 не должна переписывать индекс каждый цикл
+    new_dirs[folder_path] = [st.st_mtime_ns, newest_file, subdirs, db_files]
+
+    latest = max(st.st_mtime, latest_file)
+    db_path = os.path.join(folder_path, DB_FILE_NAME) if DB_FILE_NAME in db_files else None
+    for name in subdirs:
+        sub_latest, sub_db_path = get_folder_mtime_incremental(
+            os.path.join(folder_path, name), old_dirs, new_dirs, deadline, stats
+        )
+        latest = max(latest, sub_latest)
+        if db_path is None:
+            db_path = sub_db_path
+    return WalkResult(latest, db_path)
+
+
+def scan_task_folder(task_full_path: str, deadline: float | None = None) -> TaskScan | None:
+    """
+    Проходит по подпапкам задания (1.rvt, 2.rvt, ...) и возвращает самое свежее
+    время изменения среди их папок Data, путь к этой папке Data и к её Model.db3.
+    Если папки задания нет — возвращает None.
+
+    При включённом MTIME_INDEX_DIR обход инкрементальный; раз в
+    MTIME_INDEX_FULL_SCAN_INTERVAL секунд индекс сбрасывается и дерево
+    перечитывается целиком, чтобы не накапливать расхождения. Индекс
+    записывается, только если изменился; индекс удалённой папки стирается.
+    """
+    started = time.perf_counter()
+    stats = new_scan_stats()
+    use_index = bool(MTIME_INDEX_DIR)
+    now = time.time()
+    index = load_mtime_index(task_full_path) if use_index else None
+    if index is not None and now - index["full_scan_at"] > MTIME_INDEX_FULL_SCAN_INTERVAL:
+        index = {"full_scan_at": now, "dirs": {}}
+    new_dirs: dict = {}
+
+    try:
+        with os.scandir(task_full_path) as it:
+            subfolders = [entry.path for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        if use_index:
+            remove_mtime_index(task_full_path)
+        return None
+
+    latest_mtime_ts = 0.0
+    changed_data_folder = None
+    changed_db_path = None
+
+    for subfolder in subfolders:
+        data_folder_path = os.path.join(subfolder, "Data")
+        if not os.path.isdir(data_folder_path):
+            continue
+
+        if index is not None:
+            current = get_folder_mtime_incremental(data_folder_path, index["dirs"], new_dirs, deadline, stats)
+        else:
+            current = walk_data_folder(data_folder_path, deadline, stats)
+        if current.latest_mtime > latest_mtime_ts:
+            latest_mtime_ts = current.latest_mtime
+            changed_data_folder = data_folder_path
+            changed_db_path = current.db_path
+
+    if index is not None and new_dirs != index["dirs"]:
+        try:
+            save_mtime_index(task_full_path, {"full_scan_at": index["full_scan_at"], "dirs": new_dirs})
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить индекс mtime для {task_full_path}: {e}")
+
+    return TaskScan(latest_mtime_ts, changed_data_folder, changed_db_path,
+                    stats["dirs"], stats["stat_calls"], time.perf_counter() - started)
+
+
+def locate_db_file(dir: str, deadline: float | None = None) -> str | None:
+    """Ищет Model.db3 внутри папки Data и возвращает путь к нему."""
+    return walk_data_folder(dir, deadline).db_path
+
+
+class ScanExecutor:
+    """
+    Ограниченный пул потоков или процессов для обхода файловой системы,
+    чтобы long-running сканирование сетевой шары не блокировало polling бота.
+    """
+
+    def __init__(self, kind: str = SCAN_EXECUTOR, workers: int = SCAN_WORKERS, timeout: float = SCAN_TIMEOUT):
+        self.kind = kind
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._pool: Executor | None = None
+        # Не больше заданий в пуле, чем воркеров: таймаут отсчитывается с момента,
+        # когда задание может сразу начаться, а не пока оно стоит в очереди пула
+        self._slots: asyncio.Semaphore | None = None
+        self._slots_loop = None
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.workers)
+            self._slots_loop = loop
+        return self._slots
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.kind == "process":
+                # Журнал процессов пула пишет основной процесс — он же ротирует файл
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=log_to_queue, initargs=(child_log_queue(),),
+                )
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan")
+            logger.info(f"🧵 Пул сканирования: {self.kind} x{self.workers}")
+        return self._pool
+
+    async def run(self, func, *args, timeout: float | None = None):
+        """
+        Выполняет func(*args, deadline) в пуле. Задание ждёт свободного воркера
+        здесь, и таймаут считается от его старта. По таймауту или отмене задача
+        снимается с очереди, а уже запущенная останавливается по дедлайну.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        async with self._get_slots():
+            deadline = time.monotonic() + timeout
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._get_pool(), func, *args, deadline)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise ScanTimeout() from None
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+scan_executor = ScanExecutor()
@@ -0,0 +1,213 @@
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+from sqlalchemy import delete, or_, select
+from models import Lease, WatcherWorker, async_session, dialect_insert
+from config import WORKER_ID, SHARD_HEARTBEAT_INTERVAL, SHARD_LEASE_TTL, SHARD_VNODES
+from utils import logger
+
+
+def default_worker_id() -> str:
+    return WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+
+
+def ring_hash(value: str) -> int:
+    # hash() солится в каждом процессе — воркерам нужен одинаковый результат
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Консистентное хэширование: при уходе воркера переезжают только его папки."""
+
+    def __init__(self, workers=(), vnodes: int = SHARD_VNODES):
+        self.workers = frozenset(workers)
+        points = sorted((ring_hash(f"{worker}#{i}"), worker) for worker in self.workers for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [worker for _, worker in points]
+
+    def owner(self, key: str) -> str | None:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardCoordinator:
+    """
+    Членство воркера наблюдения в общей базе. Раз в SHARD_HEARTBEAT_INTERVAL
+    продлевает свою строку watcher_workers, удаляет просроченные (упавшие
+    воркеры) и по живым строит кольцо — все воркеры видят один состав и
+    делят папки одинаково. Папку, полученную при перебалансировке, воркер
+    берёт только через интервал heartbeat: прежний владелец должен успеть
+    заметить новый состав и отпустить её. Если продлить heartbeat не удаётся
+    дольше SHARD_LEASE_TTL, воркер перестаёт считать себя владельцем чего-либо —
+    остальные к этому времени уже разобрали его папки.
+
+    Время аренды — по часам узлов, они должны быть синхронизированы (NTP).
+    """
+
+    def __init__(self, worker_id: str | None = None, heartbeat_interval: float = SHARD_HEARTBEAT_INTERVAL,
+                 lease_ttl: float = SHARD_LEASE_TTL, vnodes: int = SHARD_VNODES):
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_ttl = max(lease_ttl, heartbeat_interval * 2)
+        self.vnodes = vnodes
+        self.ring = HashRing()
+        self._previous = HashRing()
+        self._changed_at = 0.0
+        self._renewed_at: float | None = None
+        self._started_at = datetime.utcnow()
+        self._task: asyncio.Task | None = None
+
+    def owns(self, folder: str) -> bool:
+        if self._renewed_at is None or time.monotonic() - self._renewed_at >= self.lease_ttl:
+            return False
+        if self.ring.owner(folder) != self.worker_id:
+            return False
+        return (time.monotonic() >= self._changed_at + self.heartbeat_interval
+                or self._previous.owner(folder) == self.worker_id)
+
+    async def heartbeat(self):
+        now = datetime.utcnow()
+        stmt = dialect_insert(WatcherWorker).values(
+            worker_id=self.worker_id, host=socket.gethostname(), pid=os.getpid(),
+            started_at=self._started_at, heartbeat_at=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[WatcherWorker.worker_id], set_={"heartbeat_at": stmt.excluded.heartbeat_at},
+        )
+        async with async_session() as session:
+            await session.execute(stmt)
+            await session.execute(delete(WatcherWorker).where(
+                WatcherWorker.heartbeat_at < now - timedelta(seconds=self.lease_ttl)
+            ))
+            workers = set((await session.execute(select(WatcherWorker.worker_id))).scalars())
+            await session.commit()
+        self._renewed_at = time.monotonic()
+
+        if workers != self.ring.workers:
+            joined = len(workers - self.ring.workers)
+            left = len(self.ring.workers - workers)
+            logger.info(f"🔀 Перебалансировка наблюдения: воркеров {len(workers)} (+{joined} −{left})")
+            self._previous, self.ring = self.ring, HashRing(workers, self.vnodes)
+            self._changed_at = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            logger.info(f"🧩 Воркер наблюдения {self.worker_id}")
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка heartbeat воркера {self.worker_id}: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        self._renewed_at = None
+        # Уходим сразу, а не по истечении аренды — папки переедут на следующем heartbeat
+        try:
+            async with async_session() as session:
+                await session.execute(delete(WatcherWorker).where(WatcherWorker.worker_id == self.worker_id))
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Не удалось снять регистрацию воркера {self.worker_id}: {e}")
+
+
+class LeaderLease:
+    """
+    Эксклюзивная аренда по имени в таблице leases. run() выполняет работу,
+    пока аренда у этого экземпляра: захватывает её, продлевает каждые
+    SHARD_HEARTBEAT_INTERVAL и останавливает работу, если аренду перехватили
+    или её не удалось продлить до истечения SHARD_LEASE_TTL.
+    """
+
+    def __init__(self, name: str, holder: str | None = None, ttl: float = SHARD_LEASE_TTL,
+                 renew_interval: float = SHARD_HEARTBEAT_INTERVAL):
+        self.name = name
+        self.holder = holder or default_worker_id()
+        self.ttl = max(ttl, renew_interval * 2)
+        self.renew_interval = renew_interval
+
+    async def try_acquire(self) -> bool:
+        now = datetime.utcnow()
+        stmt = dialect_insert(Lease).values(
+            name=self.name, holder=self.holder, expires_at=now + timedelta(seconds=self.ttl),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Lease.name],
+            set_={"holder": stmt.excluded.holder, "expires_at": stmt.excluded.expires_at},
+            where=or_(Lease.holder == self.holder, Lease.expires_at < now),
+        )
+        async with async_session() as session:
+            await session.execute(stmt)
+            holder = await session.scalar(select(Lease.holder).where(Lease.name == self.name))
+            await session.commit()
+        return holder == self.holder
+
+    async def release(self):
+        try:
+            async with async_session() as session:
+                await session.execute(delete(Lease).where(Lease.name == self.name, Lease.holder == self.holder))
+                await session.commit()
+        except Exception as e:
+            logger.error(f"Не удалось освободить аренду {self.name}: {e}")
+
+    async def run(self, work: Callable[[], Awaitable], stop: Callable[[], Awaitable]):
+        task: asyncio.Task | None = None
+        renewed_at = None
+        try:
+            while True:
+                try:
+                    held = await self.try_acquire()
+                    if held:
+                        renewed_at = time.monotonic()
+                except Exception as e:
+                    logger.error(f"Ошибка продления аренды {self.name}: {e}")
+                    # Пока аренда не истекла, её никто не перехватит — продолжаем
+                    held = renewed_at is not None and time.monotonic() - renewed_at < self.ttl
+
+                if held and task is None:
+                    logger.info(f"👑 Аренда {self.name} получена: {self.holder}")
+                    task = asyncio.create_task(work())
+                elif not held and task is not None:
+                    logger.warning(f"Аренда {self.name} потеряна — работа остановлена")
+                    await self._stop(task, stop)
+                    task = None
+                    renewed_at = None
+
+                if task is not None and task.done():
+                    # Работа завершилась сама (например, остановка по сигналу)
+                    return
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            if task is not None:
+                await self._stop(task, stop)
+            if renewed_at is not None:
+                await self.release()
+
+    async def _stop(self, task: asyncio.Task, stop: Callable[[], Awaitable]):
+        with suppress(Exception):
+            await stop()
+        done, _ = await asyncio.wait([task], timeout=self.renew_interval)
+        if not done:
+            task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+shard_coordinator = ShardCoordinator()
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from aiogram import Bot
+from sqlalchemy import event, or_, select, update
+from models import User, async_session, dialect_insert
+from config import (
+    PROFILE_CACHE_TTL, PROFILE_REFRESH_TTL, PROFILE_REFRESH_INTERVAL,
+    PROFILE_REFRESH_BATCH, PROFILE_REFRESH_RATE,
+    USER_CACHE_SIZE, USER_FLUSH_INTERVAL,
+)
+from dispatcher import TokenBucket
+from utils import logger
+
+
+@dataclass
+class UserProfile:
+    id: int
+    tg_id: int
+    username: str | None
+    first_name: str | None
+    loaded_at: float
+
+
+class UserProfileCache:
+    """Профили пользователей по User.id с TTL; промахи догружаются одним запросом."""
+
+    def __init__(self, ttl: float = PROFILE_CACHE_TTL):
+        self.ttl = ttl
+        self._profiles: dict[int, UserProfile] = {}
+
+    def _fresh(self, user_id: int) -> UserProfile | None:
+        profile = self._profiles.get(user_id)
+        if profile is not None and time.monotonic() - profile.loaded_at < self.ttl:
+            return profile
+        return None
+
+    async def resolve(self, session, user_ids) -> dict[int, UserProfile]:
+        profiles = {}
+        missing = []
+        for user_id in set(user_ids):
+            profile = self._fresh(user_id)
+            if profile is not None:
+                profiles[user_id] = profile
+            else:
+                missing.append(user_id)
+
+        if missing:
+            result = await session.execute(
+                select(User.id, User.tg_id, User.username, User.first_name).where(User.id.in_(missing))
+            )
+            now = time.monotonic()
+            for row in result:
+                profile = UserProfile(row.id, row.tg_id, row.username, row.first_name, now)
+                self._profiles[row.id] = profile
+                profiles[row.id] = profile
+        return profiles
+
+    def store(self, profile: UserProfile):
+        profile.loaded_at = time.monotonic()
+        self._profiles[profile.id] = profile
+
+
+class ProfileRefresher:
+    """
+    Фоновое обновление username/first_name из Telegram. Вместо get_chat на
+    каждое уведомление профили ставятся в очередь и раз в PROFILE_REFRESH_INTERVAL
+    обновляются пачкой: get_chat с ограничением частоты и один bulk UPDATE.
+    Профиль запрашивается не чаще раза в PROFILE_REFRESH_TTL секунд.
+    """
+
+    def __init__(self, bot: Bot, cache: UserProfileCache, interval: float = PROFILE_REFRESH_INTERVAL,
+                 batch_size: int = PROFILE_REFRESH_BATCH, rate: float = PROFILE_REFRESH_RATE,
+                 refresh_ttl: float = PROFILE_REFRESH_TTL):
+        self.bot = bot
+        self.cache = cache
+        self.interval = interval
+        self.batch_size = batch_size
+        self.refresh_ttl = refresh_ttl
+        self.bucket = TokenBucket(rate)
+        self._pending: dict[int, UserProfile] = {}
+        self._refreshed_at: dict[int, float] = {}
+        self._task: asyncio.Task | None = None
+
+    def request(self, profile: UserProfile):
+        refreshed_at = self._refreshed_at.get(profile.id)
+        if refreshed_at is not None and time.monotonic() - refreshed_at < self.refresh_ttl:
+            return
+        self._pending[profile.id] = profile
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления профилей: {e}")
+
+    async def refresh_batch(self):
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            _, profile = self._pending.popitem()
+            batch.append(profile)
+        if not batch:
+            return
+
+        updates = []
+        for profile in batch:
+            await self.bucket.acquire()
+            try:
+                tg_user = await self.bot.get_chat(profile.tg_id)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить данные пользователя {profile.tg_id}: {e}")
+                continue
+            self._refreshed_at[profile.id] = time.monotonic()
+            if (tg_user.username, tg_user.first_name) == (profile.username, profile.first_name):
+                continue
+            profile.username = tg_user.username
+            profile.first_name = tg_user.first_name
+            self.cache.store(profile)
+            updates.append({"id": profile.id, "username": profile.username, "first_name": profile.first_name})
+
+        if updates:
+            async with async_session() as session:
+                await session.execute(update(User), updates)
+                await session.commit()
+            logger.info(f"👥 Обновлены профили пользователей: {len(updates)}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+def user_upsert():
+    """
+    INSERT ... ON CONFLICT(tg_id) DO UPDATE, который трогает строку только если
+    username или first_name действительно изменились.
+    """
+    stmt = dialect_insert(User)
+    return stmt.on_conflict_do_update(
+        index_elements=[User.tg_id],
+        set_={"username": stmt.excluded.username, "first_name": stmt.excluded.first_name},
+        where=or_(
+            User.username.is_distinct_from(stmt.excluded.username),
+            User.first_name.is_distinct_from(stmt.excluded.first_name),
+        ),
+    )
+
+
+class UserRegistry:
+    """
+    Недавно виденные пользователи в памяти (LRU на USER_CACHE_SIZE записей).
+    Команда с неизменившимися username/first_name в БД не ходит вовсе;
+    изменения копятся и раз в USER_FLUSH_INTERVAL записываются одним upsert.
+    """
+
+    def __init__(self, max_entries: int = USER_CACHE_SIZE, flush_interval: float = USER_FLUSH_INTERVAL):
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        # tg_id -> (User.id или None, username, first_name)
+        self._known: OrderedDict[int, tuple[int | None, str | None, str | None]] = OrderedDict()
+        self._dirty: dict[int, dict] = {}
+        self._task: asyncio.Task | None = None
+
+    def _remember(self, tg_id: int, user_id: int | None, username: str | None, first_name: str | None):
+        self._known[tg_id] = (user_id, username, first_name)
+        self._known.move_to_end(tg_id)
+        while len(self._known) > self.max_entries:
+            self._known.popitem(last=False)
+
+    def touch(self, tg_id: int, username: str | None, first_name: str | None):
+        """Отмечает пользователя; запись в БД — только при изменении профиля."""
+        known = self._known.get(tg_id)
+        if known is not None and known[1:] == (username, first_name):
+            self._known.move_to_end(tg_id)
+            return
+        self._remember(tg_id, known[0] if known else None, username, first_name)
+        self._dirty[tg_id] = {"tg_id": tg_id, "username": username, "first_name": first_name}
+
+    async def ensure(self, tg_id: int, username: str | None, first_name: str | None, session=None) -> int:
+        """
+        Гарантирует наличие пользователя в БД и возвращает его User.id. С session
+        upsert выполняется в её транзакции (коммитит вызывающий): id запоминается
+        только после коммита, а при откате изменение профиля снова ставится в запись.
+        """
+        self.touch(tg_id, username, first_name)
+        known = self._known[tg_id]
+        if known[0] is not None and tg_id not in self._dirty:
+            return known[0]
+
+        row = self._dirty.pop(tg_id, {"tg_id": tg_id, "username": username, "first_name": first_name})
+        if session is not None:
+            user_id = await self._upsert(session, row)
+            self._settle_on_end(session.sync_session, row, user_id)
+            return user_id
+
+        async with async_session() as session:
+            user_id = await self._upsert(session, row)
+            await session.commit()
+        self._remember(tg_id, user_id, username, first_name)
+        return user_id
+
+    def _settle_on_end(self, sync_session, row: dict, user_id: int):
+        """По завершении транзакции вызывающего: коммит — запомнить id, иначе — вернуть row в _dirty."""
+        transaction = sync_session.get_transaction()
+        committed = settled = False
+
+        def on_commit(_):
+            nonlocal committed
+            committed = True
+
+        # Слушатели нельзя снять во время рассылки события — после первого
+        # срабатывания они ничего не делают и уходят вместе с сессией
+        def on_end(_, ended):
+            nonlocal settled
+            if settled or ended is not transaction:
+                return
+            settled = True
+            if committed:
+                self._remember(row["tg_id"], user_id, row["username"], row["first_name"])
+            else:
+                # Более свежие данные из touch() не затираем
+                self._dirty.setdefault(row["tg_id"], row)
+
+        event.listen(sync_session, "after_commit", on_commit)
+        event.listen(sync_session, "after_transaction_end", on_end)
+
+    @staticmethod
+    async def _upsert(session, row: dict) -> int:
+        result = await session.execute(user_upsert().returning(User.id), row)
+        user_id = result.scalar()
+        if user_id is None:
+            # Профиль не изменился — ON CONFLICT ничего не вернул
+            user_id = await session.scalar(select(User.id).where(User.tg_id == row["tg_id"]))
+        return user_id
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        rows, self._dirty = list(self._dirty.values()), {}
+        try:
+            async with async_session() as session:
+                await session.execute(user_upsert(), rows)
+                await session.commit()
+        except Exception:
+            for row in rows:
+                self._dirty.setdefault(row["tg_id"], row)
+            raise
+        logger.debug(f"👥 Записано профилей пользователей: {len(rows)}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка записи профилей пользователей: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+user_registry = UserRegistry()
@@ -1,9 +1,287 @@
+import atexit
+import copy
+import glob
+import gzip
+import json
 import logging
-
-logging.basicConfig(
-    filename='bot.log',
-    filemode='a', 
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s"
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from html import escape
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import (
+    TELEGRAM_API_URL,
+    LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL,
+    LOG_BACKUP_COUNT, LOG_COMPRESS, LOG_QUEUE_SIZE,
 )
-logger = logging.getLogger(__name__)
\ No newline at end of file
+
+TEXT_FORMAT = "%(asctime)s | %(levelname)s | %(message)s"
+
+# Поля контекста (цикл проверки, чат, записи outbox), которые попадают в JSON-журнал
+_log_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+
+@contextmanager
+def log_fields(**fields):
+    """Добавляет поля ко всем записям журнала внутри блока (в том числе в порождённых задачах)."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, логгер, сообщение и поля контекста."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "context", None) or _log_context.get())
+        # Из очереди запись приходит с трассировкой уже в exc_text (см. LogQueueHandler.prepare)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CompressingRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    Ротация по размеру (max_bytes) и по времени (interval секунд, границы
+    от эпохи — для 86400 это полночь UTC). Закрытый файл переименовывается
+    в bot.log.ГГГГММДД-ЧЧММСС и сжимается в .gz отдельным потоком; хранится
+    не больше backup_count архивов (0 — без ограничения).
+    """
+
+    def __init__(self, filename: str, max_bytes: int = 0, interval: int = 0,
+                 backup_count: int = 0, compress: bool = True):
+        super().__init__(filename, "a", encoding="utf-8")
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.rollover_at = self._next_rollover(time.time())
+        self._retry_at = 0.0
+
+    def _next_rollover(self, now: float) -> float | None:
+        if self.interval <= 0:
+            return None
+        return (now // self.interval + 1) * self.interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if record.created < self._retry_at:
+            return False
+        if self.rollover_at is not None and record.created >= self.rollover_at:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.seek(0, 2)
+            return self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        now = time.time()
+        self.rollover_at = self._next_rollover(now)
+        try:
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+                target = f"{self.baseFilename}.{stamp}"
+                n = 1
+                while os.path.exists(target) or os.path.exists(target + ".gz"):
+                    target = f"{self.baseFilename}.{stamp}.{n}"
+                    n += 1
+                os.replace(self.baseFilename, target)
+                if self.compress:
+                    threading.Thread(target=self._compress, args=(target,), name="log-compress", daemon=True).start()
+                else:
+                    self._prune()
+        except OSError as e:
+            # Файл держит другой процесс (Windows) — продолжаем писать, повтор через минуту
+            self._retry_at = now + 60
+            sys.stderr.write(f"Ротация журнала не удалась: {e}\n")
+        self.stream = self._open()
+
+    def _compress(self, path: str):
+        try:
+            with open(path, "rb") as src, gzip.open(path + ".gz.tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + ".gz.tmp", path + ".gz")
+            os.remove(path)
+        except OSError:
+            return
+        self._prune()
+
+    def _prune(self):
+        if self.backup_count <= 0:
+            return
+        backups = [path for path in glob.glob(glob.escape(self.baseFilename) + ".*") if not path.endswith(".tmp")]
+        backups.sort(key=os.path.getmtime)
+        for path in backups[:-self.backup_count]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+_traceback_formatter = logging.Formatter()
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт запись в очередь и сразу возвращается: запись в файл, ротация и
+    сжатие идут в потоке QueueListener. Контекст (log_fields) снимается здесь,
+    в вызывающем потоке. При переполнении очереди записи отбрасываются, а не
+    блокируют event loop; число пропущенных пишется, как только место появится.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Базовый prepare склеивает трассировку с текстом сообщения; здесь она
+        # остаётся в exc_text — текстовый формат допишет её после сообщения, JSON — в поле exc
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _traceback_formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        record.context = _log_context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": f"⚠️ Очередь журнала переполнена, пропущено записей: {self.dropped}",
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Поток записи основного процесса; его обработчики разбирают и очередь процессов пула
+_listener: logging.handlers.QueueListener | None = None
+_child_queue = None
+
+
+def _replace_root_handlers(handler: logging.Handler):
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+        old.close()
+    root.addHandler(handler)
+
+
+def _use_direct_handler(formatter: logging.Formatter):
+    """
+    Дочерний процесс, не подключённый к очереди (log_to_queue), пишет в файл
+    сам. WatchedFileHandler переоткрывает файл после ротации основным процессом.
+    """
+    file_handler = logging.handlers.WatchedFileHandler(LOG_FILE, encoding="utf-8", delay=True)
+    file_handler.setFormatter(formatter)
+    _replace_root_handlers(file_handler)
+
+
+def child_log_queue():
+    """
+    Очередь журнала для процессов пула сканирования (передаётся в log_to_queue).
+    Её разбирает отдельный поток основного процесса с тем же файлом и ротацией.
+    """
+    global _child_queue
+    if _listener is None:
+        return None
+    if _child_queue is None:
+        _child_queue = multiprocessing.Queue(LOG_QUEUE_SIZE)
+        listener = logging.handlers.QueueListener(_child_queue, *_listener.handlers)
+        listener.start()
+        atexit.register(listener.stop)
+    return _child_queue
+
+
+def log_to_queue(log_queue):
+    """Инициализатор процесса пула: записи уходят в основной процесс, файл пишет только он."""
+    if log_queue is not None:
+        _replace_root_handlers(LogQueueHandler(log_queue))
+
+
+def setup_logging():
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL.upper())
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    if multiprocessing.parent_process() is not None:
+        _use_direct_handler(formatter)
+        return
+
+    file_handler = CompressingRotatingFileHandler(
+        LOG_FILE, max_bytes=LOG_MAX_BYTES, interval=LOG_ROTATE_INTERVAL,
+        backup_count=LOG_BACKUP_COUNT, compress=LOG_COMPRESS,
+    )
+    file_handler.setFormatter(formatter)
+    handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(handler.queue, file_handler)
+    _listener.start()
+    # Дописываем очередь при выходе
+    atexit.register(_listener.stop)
+    if hasattr(os, "register_at_fork"):
+        # После fork поток записи в дочернем процессе не существует
+        os.register_at_fork(after_in_child=lambda: _use_direct_handler(formatter))
+
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+def bot_session() -> AiohttpSession | None:
+    """Сессия к своему серверу Bot API (TELEGRAM_API_URL); None — api.telegram.org."""
+    if not TELEGRAM_API_URL:
+        return None
+    return AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+
+
+def utf16_len(text: str) -> int:
+    """Длина в кодовых единицах UTF-16 — так Telegram считает лимит 4096 (эмодзи — две единицы)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def escape_clip(text: str, limit: int) -> str:
+    """HTML-экранирует text и обрезает его с «…», чтобы результат занял не больше limit единиц UTF-16."""
+    escaped = escape(text)
+    if utf16_len(escaped) <= limit:
+        return escaped
+    parts, used = [], 1  # место под «…»
+    for char in text:
+        piece = escape(char)
+        size = utf16_len(piece)
+        if used + size > limit:
+            break
+        parts.append(piece)
+        used += size
+    return "".join(parts) + "…"